@@ -0,0 +1,84 @@
+# Wall-clock and final reconstruction loss of training with the penalty on every critic step vs. lazy regularization
+# Usage: python -m benchmarks.lazy_gp --intervals 1 4 --num-iter 200
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.nn as nn
+
+from config import Config
+from utils.image import read_img, resize_img
+from utils.utils import process_config, adjust_scales
+
+
+def reconstruction_loss(singan):
+    # MSE between the real image and the fixed-noise reconstruction at the finest scale
+    config = singan.config
+    pad = nn.ZeroPad2d(int(((config.kernel_size - 1) * config.num_layers) / 2))
+    with torch.no_grad():
+        prev = torch.full(singan.reals[0].shape, 0, device=config.device)
+        for idx, (G, padded_rec_z, real, noise_amp) in enumerate(zip(singan.Gs, singan.Zs, singan.reals, singan.noise_amps)):
+            if idx > 0:
+                prev = resize_img(prev, 1 / config.scale_factor, config)[:, :, 0:real.shape[2], 0:real.shape[3]]
+            padded_prev = pad(prev)
+            prev = G(noise_amp * padded_rec_z + padded_prev, padded_prev)
+        return nn.MSELoss()(prev, singan.reals[-1]).item()
+
+
+def run(gp_interval, gp_type, args):
+    config = Config
+    config.mode = 'train'
+    config.manualSeed = args.seed
+    config.num_iter = args.num_iter
+    config.milestones = [int(args.num_iter * 0.8)]
+    config.img_save_iter = args.num_iter + 1
+    config.gp_interval = gp_interval
+    config.gp_type = gp_type
+    config.max_size = args.max_size
+    config.exp_dir = tempfile.mkdtemp(prefix='lazy_gp-')
+    if args.img_path is not None:
+        config.img_path = args.img_path
+    process_config(config)
+    adjust_scales(read_img(config), config)
+
+    # Imported here so process_config has set the device first
+    from model.SinGAN import SinGAN
+    from model.ACM_SinGAN import SinGAN_ACM
+    singan = SinGAN_ACM(config=config) if config.use_acm else SinGAN(config=config)
+
+    start = time.perf_counter()
+    singan.train()
+    elapsed = time.perf_counter() - start
+    return {'gp_type': gp_type, 'gp_interval': gp_interval, 'train_sec': elapsed, 'rec_mse': reconstruction_loss(singan)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--intervals', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--gp-type', default='wgan', choices=['wgan', 'r1'])
+    parser.add_argument('--num-iter', type=int, default=200)
+    parser.add_argument('--max-size', type=int, default=Config.max_size)
+    parser.add_argument('--img-path', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    base = {k: v for k, v in vars(Config).items() if not k.startswith('__')}
+    results = []
+    for interval in args.intervals:
+        # Every run starts from the pristine Config, train() mutates it
+        for k, v in base.items():
+            setattr(Config, k, v)
+        results.append(run(interval, args.gp_type, args))
+
+    print(f'{"gp_type":>8} {"interval":>8} {"train_sec":>10} {"speedup":>8} {"rec_mse":>10}')
+    for r in results:
+        print(f'{r["gp_type"]:>8} {r["gp_interval"]:>8} {r["train_sec"]:>10.2f} '
+              f'{results[0]["train_sec"] / r["train_sec"]:>8.2f} {r["rec_mse"]:>10.5f}')
+    if args.out is not None:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,351 @@
+# Micro/macro benchmarks of the SinGAN pipeline on a synthetic image, with a JSON baseline to catch regressions
+# Usage: python -m benchmarks.pipeline --size 250 188 --out bench.json
+#        python -m benchmarks.pipeline --size 250 188 --baseline bench.json --threshold 0.15
+import os
+import io
+import sys
+import json
+import math
+import time
+import fnmatch
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+import torch
+import torch.nn as nn
+import numpy as np
+from torch.utils.tensorboard import SummaryWriter
+
+from config import Config
+from model.generator import Generator
+from model.sampler import sample_chunks, build_pyramid_sampler
+from utils.image import imresize_in, resize_img
+from utils.layers import weights_init, reset_grads
+from utils.metrics import MetricsBuffer
+from utils.utils import process_config, adjust_scales, calcul_sr_scale, creat_reals_pyramid, generate_noise, scale_nfc
+from utils.writer import ImageWriter, HeatmapPool
+
+PRISTINE = {k: v for k, v in vars(Config).items() if not k.startswith('__')}
+
+
+def make_config(args, **overrides):
+    # Every benchmark starts from the pristine Config, the models mutate it
+    for k, v in PRISTINE.items():
+        setattr(Config, k, v)
+    Config.manualSeed = args.seed
+    Config.mode = 'train'
+    Config.use_acm = args.model == 'acm'
+    Config.exp_dir = tempfile.mkdtemp(prefix='bench-')
+    Config.img_save_iter = 10 ** 9
+    Config.checkpoint_iter = 0
+    Config.image_writer_workers = 0
+    Config.heatmap_processes = 0
+    Config.save_attention_map = False
+    Config.save_all_pyramid = False
+    for k, v in overrides.items():
+        setattr(Config, k, v)
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_config(Config)
+    torch.manual_seed(args.seed)
+    return Config
+
+
+def synthetic_image(args, config):
+    # Smooth random texture in [-1, 1], deterministic for a given seed and size
+    g = torch.Generator().manual_seed(args.seed)
+    h, w = args.size
+    img = torch.rand(1, 3, max(h // 8, 1), max(w // 8, 1), generator=g) * 2 - 1
+    img = nn.functional.interpolate(img, size=(h, w), mode='bicubic', align_corners=False).clamp(-1, 1)
+    return img.to(config.device)
+
+
+def build_model(args, config, real, num_scales=None):
+    # Model with a full real pyramid and randomly initialized frozen generators for the first num_scales scales.
+    # Timings only depend on the shapes, not on trained weights
+    from model.SinGAN import SinGAN
+    from model.ACM_SinGAN import SinGAN_ACM
+    adjust_scales(real, config)
+    singan = SinGAN_ACM(config) if config.use_acm else SinGAN(config)
+    singan.reals = creat_reals_pyramid(real, [], config)
+    singan.first_img_input = torch.full(singan.reals[0].shape, 0, device=config.device)
+
+    pad = nn.ZeroPad2d(int(((config.kernel_size - 1) * config.num_layers) / 2))
+    for scale in range(len(singan.reals) if num_scales is None else num_scales):
+        config.nfc, config.min_nfc = scale_nfc(config, scale)
+        G = Generator(config).to(config.device)
+        G.apply(weights_init)
+        singan.Gs.append(reset_grads(G, False).eval())
+        # Same Zs as train_single_stage: noise at the coarsest scale, int64 zeros above it
+        shape = [1, config.img_channel] + list(singan.reals[scale].shape[2:])
+        rec_z = generate_noise([1] + shape[2:], device=config.device).expand(*shape) if scale == 0 else \
+            torch.full(shape, 0, device=config.device)
+        singan.Zs.append(pad(rec_z))
+        singan.noise_amps.append(1 if scale == 0 else config.noise_amp)
+    if config.use_acm:
+        singan.Ds = [None] * len(singan.Gs)
+    return singan
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, repeat, warmup, device, setup=None):
+    # setup() runs untimed before every call and its result is passed to fn
+    times = []
+    for i in range(warmup + repeat):
+        args = () if setup is None else (setup(),)
+        sync(device)
+        start = time.perf_counter()
+        fn(*args)
+        sync(device)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {'median_ms': float(np.median(times)), 'min_ms': float(times.min()), 'mean_ms': float(times.mean()),
+            'std_ms': float(times.std()), 'repeat': repeat}
+
+
+def bench_resize(args, results):
+    config = make_config(args)
+    real = synthetic_image(args, config)
+    adjust_scales(real, config)
+    np_real = ((real[0].permute(1, 2, 0).cpu().numpy() + 1) * 127.5).astype(np.uint8)
+    for i in range(config.stop_scale + 1):
+        scale = math.pow(config.scale_factor, config.stop_scale - i)
+        results[f'imresize_in/scale_{i}'] = measure(lambda: imresize_in(np_real, scale_factor=scale), args.repeat, args.warmup, config.device)
+        results[f'resize_img/scale_{i}'] = measure(lambda: resize_img(real, scale, config), args.repeat, args.warmup, config.device)
+    # Upscaling between neighbouring scales, as in draw_sequentially / inference
+    coarse = resize_img(real, config.scale_factor, config)
+    results['resize_img/upscale'] = measure(lambda: resize_img(coarse, 1 / config.scale_factor, config), args.repeat, args.warmup, config.device)
+
+
+def bench_pyramid(args, results):
+    config = make_config(args)
+    real = synthetic_image(args, config)
+    adjust_scales(real, config)
+    results['creat_reals_pyramid'] = measure(lambda: creat_reals_pyramid(real, [], config), args.repeat, args.warmup, config.device)
+
+
+def bench_noise(args, results):
+    config = make_config(args)
+    h, w = args.size
+    results['generate_noise/finest'] = measure(lambda: generate_noise([config.img_channel, h, w], device=config.device),
+                                               args.repeat, args.warmup, config.device)
+    results['generate_noise/finest_batch_8'] = measure(lambda: generate_noise([config.img_channel, h, w], 8, device=config.device),
+                                                       args.repeat, args.warmup, config.device)
+
+
+def pick_scales(num_scales):
+    return sorted({0, num_scales // 2, num_scales - 1})
+
+
+def bench_train_epoch(args, results):
+    config = make_config(args)
+    real = synthetic_image(args, config)
+    adjust_scales(real, config)
+    num_scales = config.stop_scale + 1
+
+    for scale in pick_scales(num_scales):
+        def setup():
+            config = make_config(args, num_iter=1)
+            singan = build_model(args, config, real, num_scales=scale)
+            singan.writer = SummaryWriter(f'{config.exp_dir}/logs')
+            singan.metrics = MetricsBuffer(singan.writer, config.log_flush_iter)
+            singan.image_writer = ImageWriter(0)
+            if config.use_acm:
+                singan.heatmap_pool = HeatmapPool(0)
+            config.nfc, config.min_nfc = scale_nfc(config, scale)
+            config.result_dir = config.att_dir = f'{config.exp_dir}/{scale}'
+            os.makedirs(config.result_dir, exist_ok=True)
+            init = singan.init_single_layer_gan if config.use_acm else singan.init_models
+            return singan, init()
+
+        def run(state):
+            singan, (D, G) = state
+            singan.train_single_stage(D, G)
+            singan.metrics.close()
+
+        results[f'train_single_stage/epoch/scale_{scale}'] = measure(run, args.repeat, args.warmup, config.device, setup)
+
+
+def bench_draw(args, results):
+    config = make_config(args)
+    real = synthetic_image(args, config)
+    singan = build_model(args, config, real)
+    pad = nn.ZeroPad2d(int(((config.kernel_size - 1) * config.num_layers) / 2))
+    all_Gs = singan.Gs
+    for depth in pick_scales(len(all_Gs) + 1)[1:]:
+        def run():
+            singan.Gs = all_Gs[:depth]
+            with torch.no_grad():
+                singan.draw_sequentially('rand', pad, pad)
+        results[f'draw_sequentially/depth_{depth}'] = measure(run, args.repeat, args.warmup, config.device)
+    singan.Gs = all_Gs
+
+
+def bench_inference(args, results):
+    config = make_config(args, num_samples=args.num_samples)
+    real = synthetic_image(args, config)
+    singan = build_model(args, config, real)
+    config.infer_dir = f'{config.exp_dir}/infer'
+    os.makedirs(config.infer_dir, exist_ok=True)
+
+    def run():
+        with torch.no_grad():
+            singan.inference(None)
+    result = measure(run, args.repeat, args.warmup, config.device)
+    results['inference/per_sample'] = {k: v / args.num_samples if k.endswith('_ms') else v for k, v in result.items()}
+
+
+def bench_sampler(args, results):
+    # Finest-scale samples from the eager per-scale loop vs the scripted PyramidSampler, same chunks and noise
+    config = make_config(args, num_samples=args.num_samples)
+    real = synthetic_image(args, config)
+    singan = build_model(args, config, real)
+
+    for name, compiled in [('eager', False), ('scripted', True)]:
+        def run():
+            config.compile_sampler = compiled
+            try:
+                for _ in singan.generate(None):
+                    pass
+            finally:
+                config.compile_sampler = False
+        result = measure(run, args.repeat, args.warmup, config.device)
+        results[f'sampler/{name}/per_sample'] = {k: v / args.num_samples if k.endswith('_ms') else v
+                                                 for k, v in result.items()}
+
+    def setup():
+        # A sampler with its own plan, so nothing is shared with the generate() runs above
+        start_img_input = torch.full(singan.reals[0].shape, 0, device=config.device)
+        return build_pyramid_sampler(config, singan.reals, singan.sampling_generators(), singan.Zs, singan.noise_amps,
+                                     start_img_input)
+
+    def run(sampler):
+        with torch.no_grad():
+            for _, num in sample_chunks(args.num_samples, config.infer_batch_size):
+                sampler(num)
+    result = measure(run, args.repeat, args.warmup, config.device, setup)
+    results['sampler/scripted_prebuilt/per_sample'] = {k: v / args.num_samples if k.endswith('_ms') else v
+                                                       for k, v in result.items()}
+
+
+def bench_sr(args, results):
+    config = make_config(args, num_samples=1)
+    real = synthetic_image(args, config)
+
+    def setup():
+        config = make_config(args, num_samples=1, mode='train_SR')
+        in_scale, iter_num = calcul_sr_scale(config)
+        singan = build_model(args, config, real)
+        config.scale_factor = 1 / in_scale
+        config.scale_factor_init = 1 / in_scale
+        config.scale_h = config.scale_w = 1
+        config.infer_dir = f'{config.exp_dir}/infer'
+        os.makedirs(config.infer_dir, exist_ok=True)
+        return singan, iter_num
+
+    def run(state):
+        singan, iter_num = state
+        with torch.no_grad():
+            start_img_input = singan.create_sr_inference_input(singan.reals[-1], iter_num)
+            singan.inference(start_img_input)
+    results['sr/create_input_and_inference'] = measure(run, args.repeat, args.warmup, config.device, setup)
+
+
+BENCHMARKS = {
+    'resize': bench_resize,
+    'pyramid': bench_pyramid,
+    'noise': bench_noise,
+    'train_epoch': bench_train_epoch,
+    'draw': bench_draw,
+    'inference': bench_inference,
+    'sampler': bench_sampler,
+    'sr': bench_sr,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_metadata(args):
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'machine': platform.machine(),
+            'python': platform.python_version(), 'torch': torch.__version__, 'numpy': np.__version__,
+            'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+            'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None, 'git_commit': git_commit(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'threshold', 'only')}}
+
+
+def compare(results, baseline, threshold):
+    # Relative change of the median per benchmark, a regression is a slowdown beyond threshold
+    rows, regressions = [], []
+    for name, result in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            rows.append((name, None, result['median_ms'], None, 'new'))
+            continue
+        ratio = result['median_ms'] / max(base['median_ms'], 1e-9)
+        status = 'REGRESSION' if ratio > 1 + threshold else ('faster' if ratio < 1 - threshold else 'ok')
+        if status == 'REGRESSION':
+            regressions.append(name)
+        rows.append((name, base['median_ms'], result['median_ms'], ratio, status))
+
+    print(f'{"benchmark":<40} {"base_ms":>10} {"cur_ms":>10} {"ratio":>7}  status')
+    for name, base, cur, ratio, status in rows:
+        print(f'{name:<40} {"-" if base is None else f"{base:.3f}":>10} {cur:>10.3f} '
+              f'{"-" if ratio is None else f"{ratio:.2f}":>7}  {status}')
+    if baseline['metadata'].get('args') != results['metadata'].get('args'):
+        print('Warning: baseline was recorded with different benchmark arguments')
+    for key in ('processor', 'machine', 'torch', 'torch_threads', 'cuda'):
+        if baseline['metadata'].get(key) != results['metadata'].get(key):
+            print(f'Warning: baseline {key}={baseline["metadata"].get(key)!r}, now {results["metadata"].get(key)!r}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[250, 188], metavar=('H', 'W'), help='Synthetic image size')
+    parser.add_argument('--model', default='acm' if Config.use_acm else 'singan', choices=['singan', 'acm'])
+    parser.add_argument('--only', nargs='+', default=None, help=f'Benchmark groups or patterns, of {list(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--num-samples', type=int, default=4, help='Samples per inference run')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads, pin it for stable numbers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='Write the results JSON here')
+    parser.add_argument('--baseline', default=None, help='Results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative slowdown of the median')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if args.only is None or any(fnmatch.fnmatch(name, pattern) for pattern in args.only):
+            bench(args, results)
+    results = {'metadata': machine_metadata(args), 'benchmarks': results}
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+    else:
+        print(f'{"benchmark":<40} {"median_ms":>10} {"min_ms":>10}')
+        for name, result in results['benchmarks'].items():
+            print(f'{name:<40} {result["median_ms"]:>10.3f} {result["min_ms"]:>10.3f}')
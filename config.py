@@ -6,6 +6,7 @@ class Config:
     manualSeed = None
     img_channel = 3
     img_save_iter = 500
+    log_flush_iter = 50                         # Epochs of losses kept on device before one sync and a TensorBoard write
 
     # [PYRAMID PARAMETERS]
     scale_factor = 0.75                         # Pyramid scale factor pow(0.5, 1/6)
@@ -21,6 +22,9 @@ class Config:
     stride = 1
     pad = 0                                     # Don't use layer padding for variation of the samples
 
+    # [MINIBATCH]
+    batch_size = 1                              # Noise maps / prior-scale samples per critic and generator step
+
     # [GENERATOR]
     generator_iter = 3
     rec_weights = 10                            # Reconstruction loss weight
@@ -28,6 +32,8 @@ class Config:
     # [DISCRIMINATOR]
     n_critic = 3
     gp_weights = 0.1
+    gp_type = 'wgan'                            # 'wgan': WGAN-GP on real/fake interpolates, 'r1': R1 on reals
+    gp_interval = 1                             # Lazy regularization: apply the penalty every k critic steps
     # [ACM]
     num_heads = 8
     use_acm_oth = False
@@ -42,20 +48,55 @@ class Config:
     beta1 = 0.5
     beta2 = 0.999
 
+    # [CHECKPOINT]
+    checkpoint_iter = 0                         # Epochs between mid-scale checkpoints (0: off, resume at scale ends)
+    resume = False                              # Continue from the latest finished scale and mid-scale checkpoint
+
+    # [PRIOR POOL]
+    prior_pool_size = 0                         # Pre-sampled prior-scale images per scale (0: draw every step)
+    prior_pool_refresh_iter = 100               # Epochs between pool refreshes (0: never refresh)
+    prior_pool_refresh_size = None              # Entries replaced per refresh (None: the whole pool)
+    prior_pool_chunk = 32                       # Samples per batched no-grad pass when filling the pool
+    prior_prefetch = 0                          # Queue depth of the background prior sampler (0: off, pool wins)
+
+    # [IMAGE WRITER]
+    image_writer_workers = 2                    # Background threads encoding and writing PNGs (0: write inline)
+    image_writer_queue = 32                     # Pending images before the policy kicks in
+    image_writer_policy = 'block'               # 'block': wait for room, 'drop_new' / 'drop_oldest': skip images
+    heatmap_renderer = 'matplotlib'             # 'matplotlib': heatmap package, 'tensor': batched on-device (different look)
+    heatmap_processes = 4                       # Worker processes of the 'matplotlib' renderer (0: inline)
+    heatmap_grid = False                        # 'tensor' renderer: one grid image per map instead of a file per head
+
+    # [PROFILER]
+    profile = False                             # Time training phases per scale, writes exp_dir/profile_trace.json
+    profile_sync = True                         # Synchronize CUDA at phase boundaries so GPU time lands in its phase
+
     # [DATA]
     img_path = 'Input/Images/33039_LR.png'
     exp_dir = 'exp/test'                        # f'exp/balloons/scale-{scale_factor}_alp-{alpha}'
     generator_path = None                       # Saved generator path
     discriminator_path = None                   # Saved discriminator path
+    artifact_fp16 = False                       # Store the exp_dir/model.pt weights, noise maps and reals in fp16
+    pyramid_cache_dir = None                    # Reuse real image pyramids across runs, e.g. 'cache/pyramids'
 
     # [Inference]
     use_fixed_noise = True
     save_all_pyramid = True
     save_attention_map = True
+    fuse_generators = False                     # Fold BatchNorm into the convs for sampling, off by ~1e-6 from unfused
     gen_start_scale = 0
+    noise_seed = None                           # Noise keyed by (noise_seed, sample id, scale) instead of the torch RNG
+    first_sample = 0                            # Id of the first sample, e.g. one shard of a bigger noise_seed job
     scale_h = 1
     scale_w = 1
     num_samples = 10
+    infer_batch_size = 1                        # Samples pushed through each scale at once (None: all of them)
+    stream_inference = False                    # Walk the pyramid per chunk and write samples as they finish
+    prefix_cache_mb = 256                       # LRU of the fixed-noise scales below gen_start_scale (0: recompute)
+    infer_tile_size = None                      # Run generators on tiles of this many output pixels (None: whole canvas)
+    compile_sampler = False                     # Stream finest-scale samples from the scripted PyramidSampler
+    export_sampler = False                      # Save the scripted PyramidSampler to {exp_dir}/sampler.pt
 
     # [SR]
     sr_factor = 4
+    stream_sr = False                           # Upscale level by level without keeping the levels, sr.png only
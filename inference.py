@@ -1,12 +1,13 @@
 import os
 
-import matplotlib.pyplot as plt
+import torch
 
 from config import Config
 # from model.ACM_SinGAN import SinGAN_ACM as SinGAN
 from model.SinGAN import SinGAN
-from utils.image import read_img, torch2np
+from utils.image import read_img
 from utils.utils import process_config, adjust_scales, calcul_sr_scale
+from utils.writer import image_writer
 
 
 if __name__ == '__main__':
@@ -17,7 +18,8 @@ if __name__ == '__main__':
 
     inference_img = read_img(Config)
     os.makedirs(Config.infer_dir, exist_ok=True)
-    plt.imsave(f'{Config.exp_dir}/real.png', torch2np(inference_img), vmin=0, vmax=1)
+    writer = image_writer(Config)
+    writer.save(f'{Config.exp_dir}/real.png', inference_img)
 
     if Config.mode == 'train':
         adjust_scales(inference_img, Config)
@@ -28,10 +30,28 @@ if __name__ == '__main__':
         Config.scale_factor_init = 1 / in_scale
         Config.scale_w = 1
         Config.scale_h = 1
-        start_img_input = singan.create_sr_inference_input(singan.reals[-1], iter_num)
-
-    out = singan.inference(start_img_input)
-    if Config.mode == 'train_SR':
-        out = out[:, :, 0:int(Config.sr_factor * singan.reals[-1].shape[2]), 0:int(Config.sr_factor * singan.reals[-1].shape[3])]
-        plt.imsave(f'{Config.exp_dir}/sr.png', torch2np(out), vmin=0, vmax=1)
+        if not Config.stream_sr:
+            start_img_input = singan.create_sr_inference_input(singan.reals[-1], iter_num)
+
+    if Config.mode == 'train_SR' and Config.stream_sr:
+        # Level by level and tile by tile with infer_tile_size, sr.png is written in row strips
+        singan.super_resolve(iter_num, f'{Config.exp_dir}/sr.png')
+    else:
+        if Config.export_sampler:
+            # Standalone TorchScript module, torch.jit.load(path)(num_samples) samples without this repo
+            torch.jit.save(singan.pyramid_sampler(start_img_input), f'{Config.exp_dir}/sampler.pt')
+
+        if Config.stream_inference:
+            # Depth-first generation, every sample is written as soon as its chunk reaches the finest scale
+            for start, idx, images in singan.generate(start_img_input, all_scales=Config.save_all_pyramid):
+                for j in range(images.shape[0]):
+                    name = f'{start + j}_{idx}' if Config.save_all_pyramid else f'{start + j}'
+                    writer.save(f'{Config.infer_dir}/{name}.png', images[j:j + 1])
+                out = images[-1:]
+        else:
+            out = singan.inference(start_img_input)
+        if Config.mode == 'train_SR':
+            out = out[:, :, 0:int(Config.sr_factor * singan.reals[-1].shape[2]), 0:int(Config.sr_factor * singan.reals[-1].shape[3])]
+            writer.save(f'{Config.exp_dir}/sr.png', out)
+    writer.close()
 
@@ -1,8 +1,5 @@
 import os
-import math
 
-import parmap
-import heatmap
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import torch
@@ -12,19 +9,19 @@ from torch.utils.tensorboard import SummaryWriter
 
 from model.generator import Generator
 from model.ACM_discriminator import ACMDiscriminator
-from utils.loss import calcul_gp
+from model.prior import PriorImagePool, PriorImagePrefetcher
+from model.fused import fuse_generators
+from model.sampler import PyramidPlan, PrefixCache, plan_key, prefix_keys, planned_scale, sample_chunks, stream_samples, build_pyramid_sampler, sampler_samples, super_resolve
+from utils.loss import lazy_penalty
+from utils.checkpoint import load, atomic_save, rng_state, set_rng_state, checkpoint_path, load_checkpoint, remove_checkpoint, load_finished_scales
 from utils.layers import weights_init, reset_grads
-from utils.image import read_img, resize_img, torch2np
-from utils.utils import creat_reals_pyramid, generate_noise, upsampling
-
-global_att_dir = None
-global_epoch = None
-
-
-def save_heatmap(args):
-    img = args[0]
-    for idx, att in enumerate(args[1]):
-        heatmap.add(img, att, alpha=0.4, save=f'{global_att_dir}/{global_epoch}_{args[2]}_{idx}.png', axis='off')
+from utils.image import resize_img, torch2np
+from utils.utils import load_reals_pyramid, generate_noise, upsampling, scale_nfc
+from utils.artifact import finish_artifact, load_artifact
+from utils.metrics import MetricsBuffer
+from utils.profiler import PhaseProfiler
+from utils.writer import image_writer, heatmap_pool
+from utils.attention import composite_heatmaps, heatmap_frames, heatmap_grid
 
 
 class SinGAN_ACM:
@@ -36,8 +33,15 @@ class SinGAN_ACM:
         self.reals = []
         self.noise_amps = []
         self.writer = None
+        self.metrics = None
         self.first_img_input = 0
         self.log_losses = {}
+        self.prior_sampler = None
+        self.image_writer = None
+        self.heatmap_pool = None
+        self.profiler = PhaseProfiler()
+        self.plans = {}                         # plan_key -> PyramidPlan
+        self.prefix_cache = PrefixCache(int(config.prefix_cache_mb * 2 ** 20)) if config.prefix_cache_mb else None
 
     def init_single_layer_gan(self):
         generator = Generator(self.config).to(self.config.device)
@@ -55,25 +59,36 @@ class SinGAN_ACM:
         return discriminator, generator
 
     def train(self):
+        self.profiler = PhaseProfiler(self.config.profile, self.config.profile_sync, self.config.device)
+
         # Prepare image pyramid
-        train_img = read_img(self.config)
-        real = resize_img(train_img, self.config.start_scale, self.config)
-        self.reals = creat_reals_pyramid(real, self.reals, self.config)
+        with self.profiler.phase('pyramid'):
+            self.reals = load_reals_pyramid(self.config)
+
+        # Resume: skip the scales that already finished
+        finished = load_finished_scales(self.config, ['Gs', 'Ds', 'Zs', 'noiseAmp', 'reals'])
+        if finished is not None and finished[0]:
+            self.Gs, self.Ds, self.Zs, self.noise_amps, _ = finished
+            self.first_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
 
-        prev_nfc = 0
+        prev_nfc = scale_nfc(self.config, len(self.Gs) - 1)[0] if self.Gs else 0
         self.writer = SummaryWriter(f'{self.config.exp_dir}/logs')
+        self.metrics = MetricsBuffer(self.writer, self.config.log_flush_iter)
+        self.image_writer = image_writer(self.config)
+        self.heatmap_pool = heatmap_pool(self.config)
 
         # Pyramid training
-        for scale_iter in range(self.config.stop_scale+1):
+        for scale_iter in range(len(self.Gs), self.config.stop_scale+1):
+            self.profiler.start_scale(scale_iter)
+
             # Become larger as scale_iter increase (maximum=128)
-            self.config.nfc = min(self.config.nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
-            self.config.min_nfc = min(self.config.min_nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
+            self.config.nfc, self.config.min_nfc = scale_nfc(self.config, scale_iter)
 
             # Prepare directory to save images
             self.config.result_dir = f'{self.config.exp_dir}/{scale_iter}'
             self.config.att_dir = f'{self.config.result_dir}/attention'
             os.makedirs(self.config.att_dir, exist_ok=True)
-            plt.imsave(f'{self.config.result_dir}/real_scale.png', torch2np(self.reals[scale_iter]), vmin=0, vmax=1)
+            self.image_writer.save(f'{self.config.result_dir}/real_scale.png', self.reals[scale_iter])
 
             cur_discriminator, cur_generator = self.init_single_layer_gan()
             if prev_nfc == self.config.nfc:
@@ -91,20 +106,32 @@ class SinGAN_ACM:
             self.Zs.append(cur_z)
             self.noise_amps.append(self.config.noise_amp)
 
-            torch.save(self.Zs, f'{self.config.exp_dir}/Zs.pth')
-            torch.save(self.Gs, f'{self.config.exp_dir}/Gs.pth')
-            torch.save(self.Ds, f'{self.config.exp_dir}/Ds.pth')
-            torch.save(self.reals, f'{self.config.exp_dir}/reals.pth')
-            torch.save(self.noise_amps, f'{self.config.exp_dir}/noiseAmp.pth')
+            with self.profiler.phase('save_scale'):
+                atomic_save(self.Zs, f'{self.config.exp_dir}/Zs.pth')
+                atomic_save(self.Gs, f'{self.config.exp_dir}/Gs.pth')
+                atomic_save(self.Ds, f'{self.config.exp_dir}/Ds.pth')
+                atomic_save(self.reals, f'{self.config.exp_dir}/reals.pth')
+                atomic_save(self.noise_amps, f'{self.config.exp_dir}/noiseAmp.pth')
+            self.profiler.end_scale()
 
             prev_nfc = self.config.nfc
             del cur_discriminator, cur_generator
 
+        with self.profiler.phase('save_artifact'):
+            finish_artifact(self.config, self.Gs, self.Zs, self.reals, self.noise_amps,
+                            [scale_nfc(self.config, i) for i in range(len(self.Gs))], Ds=self.Ds)
+        remove_checkpoint(self.config)
+        self.metrics.close()
+        self.image_writer.close()
+        self.heatmap_pool.close()
+        self.profiler.save(self.config.exp_dir)
         return
 
     def train_single_stage(self, cur_discriminator, cur_generator):
         real = self.reals[len(self.Gs)]
         _, _, real_h, real_w = real.shape
+        batch_size = self.config.batch_size
+        prof = self.profiler
 
         # Set padding layer(Initial padding) - To Do (Change this for noise padding not zero-padding)g
         self.config.receptive_field = self.config.kernel_size + ((self.config.kernel_size - 1) * (self.config.num_layers - 1)) * self.config.stride
@@ -118,6 +145,18 @@ class SinGAN_ACM:
         D_scheduler = optim.lr_scheduler.MultiStepLR(optimizer=D_optimizer, milestones=self.config.milestones, gamma=self.config.gamma)
         G_scheduler = optim.lr_scheduler.MultiStepLR(optimizer=G_optimizer, milestones=self.config.milestones, gamma=self.config.gamma)
 
+        # Serve prior-scale samples from a pre-sampled pool, or from a background producer, instead of a full
+        # pyramid pass inside every step
+        if self.Gs and self.config.prior_pool_size:
+            self.prior_sampler = PriorImagePool(lambda num: self.draw_sequentially('rand', noise_pad, image_pad, num),
+                                                self.config.prior_pool_size, self.config.prior_pool_refresh_iter,
+                                                self.config.prior_pool_refresh_size, self.config.prior_pool_chunk)
+        elif self.Gs and self.config.prior_prefetch:
+            generator = torch.Generator(device=self.config.device)
+            generator.manual_seed(int(torch.randint(0, 2 ** 62, (1,))))
+            self.prior_sampler = PriorImagePrefetcher(lambda g: self.draw_sequentially('rand', noise_pad, image_pad, generator=g),
+                                                      self.config.prior_prefetch, generator)
+
         # Calculate noise amp(amount of info to generate) and recover prev_rec image
         if not self.Gs:
             rec_z = generate_noise([1, real_h, real_w], device=self.config.device).expand(1, 3, real_h, real_w)
@@ -126,123 +165,184 @@ class SinGAN_ACM:
             self.config.noise_amp = 1
         else:
             rec_z = torch.full([1, self.config.img_channel, real_h, real_w], 0, device=self.config.device)
-            upscaled_prev_rec_img = self.draw_sequentially('rec', noise_pad, image_pad)
+            with prof.phase('draw_sequentially'):
+                upscaled_prev_rec_img = self.draw_sequentially('rec', noise_pad, image_pad)
             criterion = nn.MSELoss()
             rmse = torch.sqrt(criterion(real, upscaled_prev_rec_img))
             self.config.noise_amp = self.config.noise_amp_init * rmse
         padded_rec_z = noise_pad(rec_z)
         padded_rec_img = image_pad(upscaled_prev_rec_img)
 
-        for epoch in tqdm(range(self.config.num_iter), desc=f'{len(self.Gs)}th GAN'):
-            random_z = generate_noise([1, real_h, real_w], device=self.config.device).expand(1, 3, real_h, real_w) \
-                if not self.Gs else generate_noise([self.config.img_channel, real_h, real_w], device=self.config.device)
+        start_epoch = 0
+        critic_step = 0
+        checkpoint = load_checkpoint(self.config, len(self.Gs))
+        if checkpoint is not None:
+            cur_generator.load_state_dict(checkpoint['generator'])
+            cur_discriminator.load_state_dict(checkpoint['discriminator'])
+            G_optimizer.load_state_dict(checkpoint['G_optimizer'])
+            D_optimizer.load_state_dict(checkpoint['D_optimizer'])
+            G_scheduler.load_state_dict(checkpoint['G_scheduler'])
+            D_scheduler.load_state_dict(checkpoint['D_scheduler'])
+            set_rng_state(checkpoint['rng'])
+            padded_rec_z = checkpoint['padded_rec_z']
+            padded_rec_img = checkpoint['padded_rec_img']
+            self.first_img_input = checkpoint['first_img_input']
+            self.config.noise_amp = checkpoint['noise_amp']
+            start_epoch = checkpoint['epoch'] + 1
+            critic_step = checkpoint['critic_step']
+
+        for epoch in tqdm(range(start_epoch, self.config.num_iter), desc=f'{len(self.Gs)}th GAN', initial=start_epoch, total=self.config.num_iter):
+            random_z = generate_noise([1, real_h, real_w], batch_size, device=self.config.device).expand(batch_size, 3, real_h, real_w) \
+                if not self.Gs else generate_noise([self.config.img_channel, real_h, real_w], batch_size, device=self.config.device)
             padded_random_z = noise_pad(random_z)
 
             # Train Discriminator: Maximize D(x) - D(G(z)) -> Minimize D(G(z)) - D(X)
             for i in range(self.config.n_critic):
                 # Make random image input
-                upscaled_prev_random_img = self.draw_sequentially('rand', noise_pad, image_pad)
-                padded_random_img = image_pad(upscaled_prev_random_img)
-                padded_random_img_with_z = self.config.noise_amp * padded_random_z + padded_random_img
+                with prof.phase('draw_sequentially'):
+                    upscaled_prev_random_img = self.draw_prev_random_img(epoch, noise_pad, image_pad, batch_size)
+                    padded_random_img = image_pad(upscaled_prev_random_img)
+                    padded_random_img_with_z = self.config.noise_amp * padded_random_z + padded_random_img
 
                 # Calculate loss with real data
                 cur_discriminator.zero_grad()
-                real_prob_out, real_acm_oth, real_add_att_maps, real_sub_att_maps = cur_discriminator(real)
-                d_real_loss = -real_prob_out.mean()                         # Maximize D(X) -> Minimize -D(X)
+                with prof.phase('D_forward'):
+                    cur_discriminator.cache_reference()
+                    real_prob_out, real_acm_oth, real_add_att_maps, real_sub_att_maps = cur_discriminator(real)
+                    d_real_loss = -real_prob_out.mean()                     # Maximize D(X) -> Minimize -D(X)
 
                 # Calculate loss with fake data
-                fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
-                fake_prob_out, fake_acm_oth, _, _ = cur_discriminator(fake.detach())
-                d_fake_loss = fake_prob_out.mean()                          # Minimize D(G(z))
+                with prof.phase('G_forward'):
+                    fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
+                with prof.phase('D_forward'):
+                    fake_prob_out, fake_acm_oth, _, _ = cur_discriminator(fake.detach())
+                    d_fake_loss = fake_prob_out.mean()                      # Minimize D(G(z))
 
-                # Gradient penalty
-                gradient_penalty = calcul_gp(cur_discriminator, real, fake, self.config.device)
+                # Gradient penalty (only every gp_interval critic steps)
+                with prof.phase('gradient_penalty'):
+                    gradient_penalty = lazy_penalty(cur_discriminator, real, fake, self.config.device, critic_step, self.config)
+                    critic_step += 1
 
                 # Update parameters
-                d_loss = d_real_loss + d_fake_loss + (gradient_penalty * self.config.gp_weights)
+                d_loss = d_real_loss + d_fake_loss
+                if gradient_penalty is not None:
+                    d_loss = d_loss + (gradient_penalty * self.config.gp_weights)
                 if self.config.use_acm_oth:
                     d_loss += (torch.abs(real_acm_oth.mean()) + torch.abs(fake_acm_oth.mean())) * self.config.acm_weights
-                d_loss.backward()
-                D_optimizer.step()
+                with prof.phase('D_backward'):
+                    d_loss.backward()
+                with prof.phase('optimizer_step'):
+                    D_optimizer.step()
+                cur_discriminator.clear_reference()
 
                 # Log losses
-                critic = -d_real_loss.item() -d_fake_loss.item()            # D(x) - D(G_z)
-                self.log_losses[f'{len(self.Gs)}th_D/d'] = d_loss.item()
+                critic = -d_real_loss.detach() - d_fake_loss.detach()      # D(x) - D(G_z)
+                self.log_losses[f'{len(self.Gs)}th_D/d'] = d_loss.detach()
                 self.log_losses[f'{len(self.Gs)}th_D/d_critic'] = critic
-                self.log_losses[f'{len(self.Gs)}th_D/d_gp'] = gradient_penalty.item()
+                if gradient_penalty is not None:
+                    self.log_losses[f'{len(self.Gs)}th_D/d_gp'] = gradient_penalty.detach()
                 if self.config.use_acm_oth:
-                    self.log_losses[f'{len(self.Gs)}th_D/d_oth'] = real_acm_oth.item() + fake_acm_oth.item()
+                    self.log_losses[f'{len(self.Gs)}th_D/d_oth'] = real_acm_oth.detach() + fake_acm_oth.detach()
 
             # Train Generator : Maximize D(G(z)) -> Minimize -D(G(z))
+            # D is fixed during the generator steps, its real branch needs no graph
+            with torch.no_grad():
+                cur_discriminator.cache_reference()
             for i in range(self.config.generator_iter):
                 cur_generator.zero_grad()
 
                 # Make fake sample for every iteration
-                upscaled_prev_random_img = self.draw_sequentially('rand', noise_pad, image_pad)
-                padded_random_img = image_pad(upscaled_prev_random_img)
-                padded_random_img_with_z = self.config.noise_amp * padded_random_z + padded_random_img
-                fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
+                with prof.phase('draw_sequentially'):
+                    upscaled_prev_random_img = self.draw_prev_random_img(epoch, noise_pad, image_pad, batch_size)
+                    padded_random_img = image_pad(upscaled_prev_random_img)
+                    padded_random_img_with_z = self.config.noise_amp * padded_random_z + padded_random_img
+                with prof.phase('G_forward'):
+                    fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
 
                 # Adversarial loss
-                fake_prob_out, _, fake_add_att_maps, fake_sub_att_maps = cur_discriminator(fake)
-                g_adv_loss = -fake_prob_out.mean()
+                with prof.phase('G_adversarial'):
+                    fake_prob_out, _, fake_add_att_maps, fake_sub_att_maps = cur_discriminator(fake)
+                    g_adv_loss = -fake_prob_out.mean()
 
                 # Reconstruction loss
-                mse_criterion = nn.MSELoss()
-                padded_rec_img_with_z = self.config.noise_amp * padded_rec_z + padded_rec_img
-                g_rec_loss = mse_criterion(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img), real)
+                with prof.phase('G_reconstruction'):
+                    mse_criterion = nn.MSELoss()
+                    padded_rec_img_with_z = self.config.noise_amp * padded_rec_z + padded_rec_img
+                    g_rec_loss = mse_criterion(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img), real)
 
                 # Update parameters
                 g_loss = g_adv_loss + (g_rec_loss * self.config.rec_weights)
-                g_loss.backward()
-                G_optimizer.step()
+                with prof.phase('G_backward'):
+                    g_loss.backward()
+                with prof.phase('optimizer_step'):
+                    G_optimizer.step()
 
                 # Log losses
-                self.log_losses[f'{len(self.Gs)}th_G/g'] = g_loss
-                self.log_losses[f'{len(self.Gs)}th_G/g_critic'] = -g_adv_loss.item()
-                self.log_losses[f'{len(self.Gs)}th_G/g_rec'] = g_rec_loss.item()
+                self.log_losses[f'{len(self.Gs)}th_G/g'] = g_loss.detach()
+                self.log_losses[f'{len(self.Gs)}th_G/g_critic'] = -g_adv_loss.detach()
+                self.log_losses[f'{len(self.Gs)}th_G/g_rec'] = g_rec_loss.detach()
+            cur_discriminator.clear_reference()
 
-            # Log losses
-            for key, value in self.log_losses.items():
-                self.writer.add_scalar(key, value, epoch)
-            self.log_losses = {}
+            # Log losses (kept on device, written every log_flush_iter epochs)
+            with prof.phase('logging'):
+                self.metrics.log(self.log_losses, epoch)
+                self.log_losses = {}
 
             # Log image
             if epoch % self.config.img_save_iter == 0 or epoch == (self.config.num_iter - 1):
-                np_real = torch2np(real)
-                np_fake = torch2np(fake.detach())
-                plt.imsave(f'{self.config.result_dir}/{epoch}_fake_sample.png', np_fake, vmin=0, vmax=1)
-                plt.imsave(f'{self.config.result_dir}/{epoch}_fixed_noise.png', torch2np(padded_rec_img_with_z.detach() * 2 - 1), vmin=0, vmax=1)
-                plt.imsave(f'{self.config.result_dir}/{epoch}_reconstruction.png', torch2np(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img).detach()), vmin=0, vmax=1)
-                real_add_att_maps = real_add_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                real_sub_att_maps = real_sub_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                fake_add_att_maps = fake_add_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                fake_sub_att_maps = fake_sub_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-
-                global global_att_dir
-                global global_epoch
-                global_att_dir = self.config.att_dir
-                global_epoch = epoch
-
-                parmap.map(save_heatmap, [[np_real, real_add_att_maps, 'real_add'], [np_real, real_sub_att_maps, 'real_sub'],
-                                          [np_fake, fake_add_att_maps, 'fake_add'], [np_real, fake_sub_att_maps, 'fake_sub']],
-                           pm_pbar=False, pm_processes=4)
+                with prof.phase('image_saving'):
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_fake_sample.png', fake.detach())
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_fixed_noise.png', padded_rec_img_with_z.detach() * 2 - 1)
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_reconstruction.png', cur_generator(padded_rec_img_with_z.detach(), padded_rec_img).detach())
+                    fake = fake[-1:].detach()
+                    self.save_attention_maps([(real, real_add_att_maps, f'{self.config.att_dir}/{epoch}_real_add'),
+                                              (real, real_sub_att_maps, f'{self.config.att_dir}/{epoch}_real_sub'),
+                                              (fake, fake_add_att_maps[-1:], f'{self.config.att_dir}/{epoch}_fake_add'),
+                                              (real, fake_sub_att_maps[-1:], f'{self.config.att_dir}/{epoch}_fake_sub')])
 
             D_scheduler.step()
             G_scheduler.step()
 
+            if self.config.checkpoint_iter and (epoch + 1) % self.config.checkpoint_iter == 0:
+                with prof.phase('checkpoint'):
+                    self.metrics.flush()
+                    atomic_save({'scale': len(self.Gs), 'epoch': epoch, 'critic_step': critic_step,
+                                 'generator': cur_generator.state_dict(), 'discriminator': cur_discriminator.state_dict(),
+                                 'G_optimizer': G_optimizer.state_dict(), 'D_optimizer': D_optimizer.state_dict(),
+                                 'G_scheduler': G_scheduler.state_dict(), 'D_scheduler': D_scheduler.state_dict(),
+                                 'rng': rng_state(), 'padded_rec_z': padded_rec_z, 'padded_rec_img': padded_rec_img,
+                                 'first_img_input': self.first_img_input, 'noise_amp': self.config.noise_amp},
+                                checkpoint_path(self.config))
+
+        if self.prior_sampler is not None:
+            self.prior_sampler.close()
+            stats = self.prior_sampler.stats()
+            print(f'{len(self.Gs)}th GAN {type(self.prior_sampler).__name__}: ' + ', '.join(f'{k}={round(v, 2)}' for k, v in stats.items()))
+            for key, value in stats.items():
+                self.metrics.scalar(f'{self.prior_sampler.tag}/{key}', value, len(self.Gs))
+            self.prior_sampler = None
+
         # Save model weights
-        torch.save(cur_generator.state_dict(), f'{self.config.result_dir}/generator.pth')
-        torch.save(cur_discriminator.state_dict(), f'{self.config.result_dir}/ACM_discriminator.pth')
+        atomic_save(cur_generator.state_dict(), f'{self.config.result_dir}/generator.pth')
+        atomic_save(cur_discriminator.state_dict(), f'{self.config.result_dir}/ACM_discriminator.pth')
 
         return padded_rec_z, cur_generator, cur_discriminator
 
-    def draw_sequentially(self, mode, m_noise, m_image):
+    def draw_prev_random_img(self, epoch, m_noise, m_image, num_samples=1):
+        if self.prior_sampler is not None:
+            return self.prior_sampler.get(epoch, num_samples)
+        return self.draw_sequentially('rand', m_noise, m_image, num_samples)
+
+    def sampling_generators(self):
+        # Frozen generators used for sampling, with their BatchNorms folded into the convs
+        return fuse_generators(self.Gs) if self.config.fuse_generators else self.Gs
+
+    def draw_sequentially(self, mode, m_noise, m_image, num_samples=1, generator=None):
         upscaled_prev = self.first_img_input
         if len(self.Gs) > 0:
             if mode == 'rec':
                 count = 0
-                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.Gs, self.Zs, self.reals, self.reals[1:], self.noise_amps):
+                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.sampling_generators(), self.Zs, self.reals, self.reals[1:], self.noise_amps):
                     upscaled_prev = upscaled_prev[:, :, 0:cur_real.shape[2], 0:cur_real.shape[3]]
                     padded_img = m_image(upscaled_prev)
                     padded_img_with_z = noise_amp * padded_rec_z + padded_img
@@ -253,12 +353,12 @@ class SinGAN_ACM:
             elif mode == 'rand':
                 count = 0
                 pad_noise = int(((self.config.kernel_size - 1) * self.config.num_layers) / 2)
-                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.Gs, self.Zs, self.reals, self.reals[1:], self.noise_amps):
+                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.sampling_generators(), self.Zs, self.reals, self.reals[1:], self.noise_amps):
                     if count == 0:  # Generate random 1-channel noise
-                        random_noise = generate_noise([1, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], device=self.config.device)
-                        random_noise = random_noise.expand(1, 3, random_noise.shape[2], random_noise.shape[3])
+                        random_noise = generate_noise([1, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], num_samples, device=self.config.device, generator=generator)
+                        random_noise = random_noise.expand(num_samples, 3, random_noise.shape[2], random_noise.shape[3])
                     else:           # Generate random 3-channel noise
-                        random_noise = generate_noise([self.config.img_channel, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], device=self.config.device)
+                        random_noise = generate_noise([self.config.img_channel, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], num_samples, device=self.config.device, generator=generator)
                     padded_noise = m_noise(random_noise)
                     upscaled_prev = upscaled_prev[:, :, 0:cur_real.shape[2], 0:cur_real.shape[3]]
                     padded_img = m_image(upscaled_prev)
@@ -270,12 +370,18 @@ class SinGAN_ACM:
         return upscaled_prev
 
     def load_trained_weights(self):
-        if os.path.exists(self.config.exp_dir):
-            self.Gs = torch.load(f'{self.config.exp_dir}/Gs.pth')
-            self.Ds = torch.load(f'{self.config.exp_dir}/Ds.pth')
-            self.Zs = torch.load(f'{self.config.exp_dir}/Zs.pth')
-            self.noise_amps = torch.load(f'{self.config.exp_dir}/noiseAmp.pth')
-            self.reals = torch.load(f'{self.config.exp_dir}/reals.pth')
+        if os.path.exists(f'{self.config.exp_dir}/model.pt'):
+            # Memory-mapped artifact, networks are built on first access and the discriminators
+            # only when attention maps are saved
+            artifact = load_artifact(f'{self.config.exp_dir}/model.pt', self.config, load_ds=self.config.save_attention_map)
+            self.Gs, self.Ds, self.Zs = artifact['Gs'], artifact['Ds'], artifact['Zs']
+            self.reals, self.noise_amps = artifact['reals'], artifact['noise_amps']
+        elif os.path.exists(self.config.exp_dir):
+            self.Gs = load(f'{self.config.exp_dir}/Gs.pth')
+            self.Ds = load(f'{self.config.exp_dir}/Ds.pth')
+            self.Zs = load(f'{self.config.exp_dir}/Zs.pth')
+            self.noise_amps = load(f'{self.config.exp_dir}/noiseAmp.pth')
+            self.reals = load(f'{self.config.exp_dir}/reals.pth')
 
     def create_inference_input(self):
         real = self.reals[self.config.gen_start_scale]
@@ -290,7 +396,7 @@ class SinGAN_ACM:
         resized_real = real
         pad = nn.ZeroPad2d(5)
         finest_G = self.Gs[-1]
-        finest_D = self.Ds[-1]
+        finest_D = self.Ds[-1] if self.Ds is not None else None
         finest_noise_amp = self.noise_amps[-1]
 
         self.Zs = []
@@ -313,81 +419,109 @@ class SinGAN_ACM:
 
         return self.reals[0]
 
+    def generate(self, start_img_input, num_samples=None, batch_size=None, all_scales=False, first_sample=None):
+        # Generator API: yields (first sample index, scale index, images) as soon as each chunk is finished
+        if start_img_input is None:
+            start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
+        num_samples = self.config.num_samples if num_samples is None else num_samples
+        batch_size = self.config.infer_batch_size if batch_size is None else batch_size
+        first_sample = self.config.first_sample if first_sample is None else first_sample
+        # The scripted sampler draws from the torch RNG, keyed noise runs eagerly
+        if self.config.compile_sampler and not all_scales and self.config.noise_seed is None:
+            return sampler_samples(self.pyramid_sampler(start_img_input), len(self.Gs) - 1, num_samples, batch_size,
+                                   first_sample)
+        return stream_samples(self.config, self.reals, self.sampling_generators(), self.Zs, self.noise_amps, start_img_input,
+                              num_samples, batch_size, all_scales, self.sampling_plan(start_img_input), self.prefix_cache,
+                              first_sample)
+
+    def sampling_plan(self, start_img_input):
+        # Shapes, crops and resize operators of every scale, worked out once per sampling geometry
+        key = plan_key(self.config, self.reals, self.Zs, start_img_input)
+        if key not in self.plans:
+            self.plans[key] = PyramidPlan(self.config, self.reals, self.Zs, start_img_input)
+        return self.plans[key]
+
+    def super_resolve(self, iter_num, path):
+        # Streaming alternative to create_sr_inference_input + inference(), writes one SR sample to path
+        with torch.no_grad():
+            super_resolve(self.config, self.sampling_generators()[-1], self.noise_amps[-1], self.reals[-1], iter_num, path)
+
+    def pyramid_sampler(self, start_img_input=None, script=True):
+        # All frozen scales as one (scripted) module, forward(num_samples) -> finest-scale samples
+        if start_img_input is None:
+            start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
+        return build_pyramid_sampler(self.config, self.reals, self.sampling_generators(), self.Zs, self.noise_amps,
+                                     start_img_input, script, self.sampling_plan(start_img_input))
+
     def inference(self, start_img_input):
         if self.config.save_attention_map:
-            global global_att_dir
-            global global_epoch
-            global_att_dir = f'{self.config.infer_dir}/attention'
-            os.makedirs(global_att_dir, exist_ok=True)
+            os.makedirs(f'{self.config.infer_dir}/attention', exist_ok=True)
 
         if start_img_input is None:
             start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
-
-        cur_images = []
-
-        for idx, (G, D, Z_opt, noise_amp, real) in enumerate(zip(self.Gs, self.Ds, self.Zs, self.noise_amps, self.reals)):
-            padding_size = ((self.config.kernel_size - 1) * self.config.num_layers) / 2
-            pad = nn.ZeroPad2d(int(padding_size))
-            output_h = (Z_opt.shape[2] - padding_size * 2) * self.config.scale_h
-            output_w = (Z_opt.shape[3] - padding_size * 2) * self.config.scale_w
-
+        self.image_writer = image_writer(self.config)
+        self.heatmap_pool = heatmap_pool(self.config)
+        plan = self.sampling_plan(start_img_input)
+        Gs = self.sampling_generators()
+        keys = prefix_keys(plan, Gs, self.Zs, self.noise_amps, start_img_input) \
+            if self.prefix_cache is not None else [None] * len(Gs)
+
+        cur_images = None
+        for idx in range(len(Gs)):
             prev_images = cur_images
             cur_images = []
 
-            for i in tqdm(range(self.config.num_samples)):
-                if idx == 0:
-                    random_z = generate_noise([1, output_h, output_w], device=self.config.device)
-                    random_z = random_z.expand(1, 3, random_z.shape[2], random_z.shape[3])
-                    padded_random_z = pad(random_z)
-                else:
-                    random_z = generate_noise([self.config.img_channel, output_h, output_w], device=self.config.device)
-                    padded_random_z = pad(random_z)
-
-                if self.config.use_fixed_noise and idx < self.config.gen_start_scale:
-                    padded_random_z = Z_opt
+            # Push the samples through this scale in chunks of infer_batch_size
+            for start, num in tqdm(sample_chunks(self.config.num_samples, self.config.infer_batch_size)):
+                prev = None if prev_images is None else prev_images[start:start + num]
+                cur_image = planned_scale(self.config, plan, idx, Gs, self.Zs, self.noise_amps, prev, start_img_input, num,
+                                          self.prefix_cache, keys[idx], self.config.first_sample + start)
 
-                if not prev_images:
-                    padded_random_img = pad(start_img_input)
-                else:
-                    prev_img = prev_images[i]
-                    upscaled_prev_random_img = resize_img(prev_img, 1 / self.config.scale_factor, self.config)
-                    if self.config.mode == "train_SR":
-                        padded_random_img = pad(upscaled_prev_random_img)
-                    else:
-                        upscaled_prev_random_img = upscaled_prev_random_img[:, :,
-                                                   0:round(self.config.scale_h * self.reals[idx].shape[2]),
-                                                   0:round(self.config.scale_w * self.reals[idx].shape[3])]
-                        padded_random_img = pad(upscaled_prev_random_img)
-                        padded_random_img = padded_random_img[:, :, 0:padded_random_z.shape[2], 0:padded_random_z.shape[3]]
-                        padded_random_img = upsampling(padded_random_img, padded_random_z.shape[2], padded_random_z.shape[3])
-
-                padded_random_img_with_z = noise_amp * padded_random_z + padded_random_img
-                cur_image = G(padded_random_img_with_z.detach(), padded_random_img)
-
-                np_cur_image = torch2np(cur_image.detach())
-                if self.config.save_all_pyramid:
-                    plt.imsave(f'{self.config.infer_dir}/{i}_{idx}.png', np_cur_image, vmin=0, vmax=1)
-                    if self.config.save_attention_map:
-                        np_real = torch2np(real)
-                        _, _, cur_add_att_maps, cur_sub_att_maps = D(cur_image.detach())
-                        cur_add_att_maps = cur_add_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                        cur_sub_att_maps = cur_sub_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                        global_epoch = f'{i}_{idx}thG'
-                        parmap.map(save_heatmap, [[np_cur_image, cur_add_att_maps, 'infer_add'], [np_real, cur_sub_att_maps, 'infer_sub']],
-                                   pm_pbar=False, pm_processes=2)
-
-                elif idx == len(self.reals) - 1:
-                    plt.imsave(f'{self.config.infer_dir}/{i}.png', np_cur_image, vmin=0, vmax=1)
-                    if self.config.save_attention_map:
-                        np_real = torch2np(real)
-                        _, _, cur_add_att_maps, cur_sub_att_maps = D(cur_image.detach())
-                        cur_add_att_maps = cur_add_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                        cur_sub_att_maps = cur_sub_att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
-                        global_epoch = f'{i}_{idx}thG'
-                        parmap.map(save_heatmap, [[np_cur_image, cur_add_att_maps, 'infer_add'], [np_real, cur_sub_att_maps, 'infer_sub']],
-                                   pm_pbar=False, pm_processes=2)
+                if self.config.save_all_pyramid or idx == len(self.reals) - 1:
+                    self.save_inference_images(cur_image, self.config.first_sample + start, idx, self.reals[idx])
 
                 cur_images.append(cur_image)
+            cur_images = torch.cat(cur_images, dim=0)
 
-        return cur_image.detach()
+        self.image_writer.close()
+        self.heatmap_pool.close()
+        return cur_images[-1:]
 
+    def save_inference_images(self, cur_image, start, idx, real):
+        if self.config.save_attention_map:
+            _, _, cur_add_att_maps, cur_sub_att_maps = self.Ds[idx](cur_image)
+
+        att_jobs = []
+        for j in range(cur_image.shape[0]):
+            i = start + j
+            if self.config.save_all_pyramid:
+                self.image_writer.save(f'{self.config.infer_dir}/{i}_{idx}.png', cur_image[j:j + 1])
+            else:
+                self.image_writer.save(f'{self.config.infer_dir}/{i}.png', cur_image[j:j + 1])
+            if self.config.save_attention_map:
+                att_prefix = f'{self.config.infer_dir}/attention/{i}_{idx}thG'
+                att_jobs.append((cur_image[j:j + 1], cur_add_att_maps[j:j + 1], f'{att_prefix}_infer_add'))
+                att_jobs.append((real, cur_sub_att_maps, f'{att_prefix}_infer_sub'))     # Sub maps come from the real reference
+        self.save_attention_maps(att_jobs)
+
+    def save_attention_maps(self, jobs):
+        # jobs: (image [1, C, H, W], attention maps [1, num_heads, h, w], save prefix), heads go to {prefix}_{head}.png
+        if self.config.heatmap_renderer == 'matplotlib':
+            for img, att_maps, save_prefix in jobs:
+                att_maps = att_maps.detach().to(torch.device('cpu')).numpy().transpose(1, 2, 3, 0)
+                self.heatmap_pool.submit(torch2np(img), att_maps, save_prefix)
+            return
+
+        # Jobs with the same image and map sizes are composited in one batch
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job[0].shape, job[1].shape), []).append(job)
+        for group in groups.values():
+            imgs = torch.cat([img for img, _, _ in group], dim=0)
+            att_maps = torch.cat([att_maps for _, att_maps, _ in group], dim=0)
+            for (_, _, save_prefix), frames in zip(group, heatmap_frames(composite_heatmaps(imgs, att_maps))):
+                if self.config.heatmap_grid:
+                    self.image_writer.save(f'{save_prefix}.png', heatmap_grid(frames))
+                else:
+                    for head, frame in enumerate(frames):
+                        self.image_writer.save(f'{save_prefix}_{head}.png', frame)
@@ -9,6 +9,7 @@ class ACMDiscriminator(nn.Module):
     def __init__(self, config, num_heads, real):
         super(ACMDiscriminator, self).__init__()
         self.ans = real
+        self.ans_feature = None                 # Cached body(head(ans)), valid until the next parameter update
         self.config = config
         self.is_cuda = torch.cuda.is_available()
 
@@ -23,12 +24,28 @@ class ACMDiscriminator(nn.Module):
         # WGAN-GP discriminator has no activation at last layer
         self.tail = nn.Conv2d(max(N, config.min_nfc), 1, kernel_size=config.kernel_size, stride=1, padding=config.pad)
 
-    def forward(self, x):
-        x_feature = self.head(x)
+    def reference_features(self):
         ans_feature = self.head(self.ans)
-
-        x_feature = self.body(x_feature)
         ans_feature = self.body(ans_feature)
+        return ans_feature
+
+    def cache_reference(self):
+        # The real image is fixed within a scale, so its features only change when the parameters do.
+        # Call once per parameter update (inside no_grad when D is not being trained) and clear after the step.
+        self.ans_feature = self.reference_features()
+
+    def clear_reference(self):
+        self.ans_feature = None
+
+    def forward(self, x, ans_feature=None):
+        if ans_feature is None:
+            ans_feature = self.ans_feature if self.ans_feature is not None else self.reference_features()
+
+        if x is self.ans and self.ans_feature is not None:
+            x_feature = ans_feature             # D(real) shares the cached reference branch
+        else:
+            x_feature = self.head(x)
+            x_feature = self.body(x_feature)
 
         x, oth, add_att_maps, sub_att_maps = self.acm(x_feature, ans_feature)
         x = self.tail(x)
@@ -1,7 +1,5 @@
 import os
-import math
 
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import torch
 import torch.nn as nn
@@ -11,10 +9,18 @@ from torchsummary import summary
 
 from model.generator import Generator
 from model.discriminator import Discriminator
-from utils.loss import calcul_gp
+from model.prior import PriorImagePool, PriorImagePrefetcher
+from model.fused import fuse_generators
+from model.sampler import PyramidPlan, PrefixCache, plan_key, prefix_keys, planned_scale, sample_chunks, stream_samples, build_pyramid_sampler, sampler_samples, super_resolve
+from utils.loss import lazy_penalty
+from utils.checkpoint import load, atomic_save, rng_state, set_rng_state, checkpoint_path, load_checkpoint, remove_checkpoint, load_finished_scales
 from utils.layers import weights_init, reset_grads
-from utils.image import read_img, resize_img, torch2np
-from utils.utils import creat_reals_pyramid, generate_noise, upsampling
+from utils.image import resize_img
+from utils.utils import load_reals_pyramid, generate_noise, upsampling, scale_nfc
+from utils.artifact import finish_artifact, load_artifact
+from utils.metrics import MetricsBuffer
+from utils.profiler import PhaseProfiler
+from utils.writer import image_writer
 
 
 class SinGAN:
@@ -25,8 +31,14 @@ class SinGAN:
         self.reals = []
         self.noise_amps = []
         self.writer = None
+        self.metrics = None
         self.first_img_input = None
         self.log_losses = {}
+        self.prior_sampler = None
+        self.image_writer = None
+        self.profiler = PhaseProfiler()
+        self.plans = {}                         # plan_key -> PyramidPlan
+        self.prefix_cache = PrefixCache(int(config.prefix_cache_mb * 2 ** 20)) if config.prefix_cache_mb else None
 
     def init_models(self):
         generator = Generator(self.config).to(self.config.device)
@@ -44,24 +56,34 @@ class SinGAN:
         return discriminator, generator
 
     def train(self):
+        self.profiler = PhaseProfiler(self.config.profile, self.config.profile_sync, self.config.device)
+
         # Prepare image pyramid
-        train_img = read_img(self.config)
-        real = resize_img(train_img, self.config.start_scale, self.config)
-        self.reals = creat_reals_pyramid(real, self.reals, self.config)
+        with self.profiler.phase('pyramid'):
+            self.reals = load_reals_pyramid(self.config)
+
+        # Resume: skip the scales that already finished
+        finished = load_finished_scales(self.config, ['Gs', 'Zs', 'noiseAmp', 'reals'])
+        if finished is not None and finished[0]:
+            self.Gs, self.Zs, self.noise_amps, _ = finished
+            self.first_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
 
-        prev_nfc = 0
+        prev_nfc = scale_nfc(self.config, len(self.Gs) - 1)[0] if self.Gs else 0
         self.writer = SummaryWriter(f'{self.config.exp_dir}/logs')
+        self.metrics = MetricsBuffer(self.writer, self.config.log_flush_iter)
+        self.image_writer = image_writer(self.config)
 
         # Pyramid training
-        for scale_iter in range(self.config.stop_scale+1):
+        for scale_iter in range(len(self.Gs), self.config.stop_scale+1):
+            self.profiler.start_scale(scale_iter)
+
             # Become larger as scale_iter increase (maximum=128)
-            self.config.nfc = min(self.config.nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
-            self.config.min_nfc = min(self.config.min_nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
+            self.config.nfc, self.config.min_nfc = scale_nfc(self.config, scale_iter)
 
             # Prepare directory to save images
             self.config.result_dir = f'{self.config.exp_dir}/{scale_iter}'
             os.makedirs(self.config.result_dir, exist_ok=True)
-            plt.imsave(f'{self.config.result_dir}/real_scale.png', torch2np(self.reals[scale_iter]), vmin=0, vmax=1)
+            self.image_writer.save(f'{self.config.result_dir}/real_scale.png', self.reals[scale_iter])
 
             cur_discriminator, cur_generator = self.init_models()
 
@@ -79,19 +101,30 @@ class SinGAN:
             self.Zs.append(cur_z)
             self.noise_amps.append(self.config.noise_amp)
 
-            torch.save(self.Zs, f'{self.config.exp_dir}/Zs.pth')
-            torch.save(self.Gs, f'{self.config.exp_dir}/Gs.pth')
-            torch.save(self.reals, f'{self.config.exp_dir}/reals.pth')
-            torch.save(self.noise_amps, f'{self.config.exp_dir}/noiseAmp.pth')
+            with self.profiler.phase('save_scale'):
+                atomic_save(self.Zs, f'{self.config.exp_dir}/Zs.pth')
+                atomic_save(self.Gs, f'{self.config.exp_dir}/Gs.pth')
+                atomic_save(self.reals, f'{self.config.exp_dir}/reals.pth')
+                atomic_save(self.noise_amps, f'{self.config.exp_dir}/noiseAmp.pth')
+            self.profiler.end_scale()
 
             prev_nfc = self.config.nfc
             del cur_discriminator, cur_generator
 
+        with self.profiler.phase('save_artifact'):
+            finish_artifact(self.config, self.Gs, self.Zs, self.reals, self.noise_amps,
+                            [scale_nfc(self.config, i) for i in range(len(self.Gs))], Ds=None)
+        remove_checkpoint(self.config)
+        self.metrics.close()
+        self.image_writer.close()
+        self.profiler.save(self.config.exp_dir)
         return
 
     def train_single_stage(self, cur_discriminator, cur_generator):
         real = self.reals[len(self.Gs)]
         _, _, real_h, real_w = real.shape
+        batch_size = self.config.batch_size
+        prof = self.profiler
 
         # Set padding layer(Initial padding) - To Do (Change this for noise padding not zero-padding)g
         self.config.receptive_field = self.config.kernel_size + ((self.config.kernel_size - 1) * (self.config.num_layers - 1)) * self.config.stride
@@ -105,15 +138,45 @@ class SinGAN:
         D_scheduler = optim.lr_scheduler.MultiStepLR(optimizer=D_optimizer, milestones=self.config.milestones, gamma=self.config.gamma)
         G_scheduler = optim.lr_scheduler.MultiStepLR(optimizer=G_optimizer, milestones=self.config.milestones, gamma=self.config.gamma)
 
+        # Serve prior-scale samples from a pre-sampled pool, or from a background producer, instead of a full
+        # pyramid pass inside every step
+        if self.Gs and self.config.prior_pool_size:
+            self.prior_sampler = PriorImagePool(lambda num: self.draw_sequentially('rand', noise_pad, image_pad, num),
+                                                self.config.prior_pool_size, self.config.prior_pool_refresh_iter,
+                                                self.config.prior_pool_refresh_size, self.config.prior_pool_chunk)
+        elif self.Gs and self.config.prior_prefetch:
+            generator = torch.Generator(device=self.config.device)
+            generator.manual_seed(int(torch.randint(0, 2 ** 62, (1,))))
+            self.prior_sampler = PriorImagePrefetcher(lambda g: self.draw_sequentially('rand', noise_pad, image_pad, generator=g),
+                                                      self.config.prior_prefetch, generator)
+
         rec_z = torch.full([1, self.config.img_channel, real_h, real_w], 0, device=self.config.device)
 
-        for epoch in tqdm(range(self.config.num_iter), desc=f'{len(self.Gs)}th GAN'):
+        start_epoch = 0
+        critic_step = 0
+        checkpoint = load_checkpoint(self.config, len(self.Gs))
+        if checkpoint is not None:
+            cur_generator.load_state_dict(checkpoint['generator'])
+            cur_discriminator.load_state_dict(checkpoint['discriminator'])
+            G_optimizer.load_state_dict(checkpoint['G_optimizer'])
+            D_optimizer.load_state_dict(checkpoint['D_optimizer'])
+            G_scheduler.load_state_dict(checkpoint['G_scheduler'])
+            D_scheduler.load_state_dict(checkpoint['D_scheduler'])
+            set_rng_state(checkpoint['rng'])
+            rec_z = checkpoint['rec_z']
+            padded_rec_img = checkpoint['padded_rec_img']
+            self.first_img_input = checkpoint['first_img_input']
+            self.config.noise_amp = checkpoint['noise_amp']
+            start_epoch = checkpoint['epoch'] + 1
+            critic_step = checkpoint['critic_step']
+
+        for epoch in tqdm(range(start_epoch, self.config.num_iter), desc=f'{len(self.Gs)}th GAN', initial=start_epoch, total=self.config.num_iter):
             # Make noise input
             if not self.Gs:
                 rec_z = generate_noise([1, real_h, real_w], device=self.config.device).expand(1, 3, real_h, real_w)
-                random_z = generate_noise([1, real_h, real_w], device=self.config.device).expand(1, 3, real_h, real_w)
+                random_z = generate_noise([1, real_h, real_w], batch_size, device=self.config.device).expand(batch_size, 3, real_h, real_w)
             else:
-                random_z = generate_noise([self.config.img_channel, real_h, real_w], device=self.config.device)
+                random_z = generate_noise([self.config.img_channel, real_h, real_w], batch_size, device=self.config.device)
             padded_rec_z = noise_pad(rec_z)
             padded_random_z = noise_pad(random_z)
 
@@ -121,10 +184,11 @@ class SinGAN:
             for i in range(self.config.n_critic):
                 # Train with real data
                 cur_discriminator.zero_grad()
-                real_prob_out = cur_discriminator(real)
-                d_real_loss = -real_prob_out.mean()                         # Maximize D(X) -> Minimize -D(X)
-                d_real_loss.backward(retain_graph=True)
-                D_x = -d_real_loss.item()
+                with prof.phase('D_real'):
+                    real_prob_out = cur_discriminator(real)
+                    d_real_loss = -real_prob_out.mean()                     # Maximize D(X) -> Minimize -D(X)
+                    d_real_loss.backward(retain_graph=True)
+                    D_x = -d_real_loss.detach()
 
                 if i == 0 and epoch == 0:
                     if not self.Gs:
@@ -135,16 +199,18 @@ class SinGAN:
                         padded_rec_img = image_pad(upscaled_prev_rec_img)
                         self.config.noise_amp = 1
                     else:
-                        upscaled_prev_random_img = self.draw_sequentially('rand', noise_pad, image_pad)
-                        padded_random_img = image_pad(upscaled_prev_random_img)
-                        upscaled_prev_rec_img = self.draw_sequentially('rec', noise_pad, image_pad)
+                        with prof.phase('draw_sequentially'):
+                            upscaled_prev_random_img = self.draw_prev_random_img(epoch, noise_pad, image_pad, batch_size)
+                            padded_random_img = image_pad(upscaled_prev_random_img)
+                            upscaled_prev_rec_img = self.draw_sequentially('rec', noise_pad, image_pad)
                         criterion = nn.MSELoss()
                         rmse = torch.sqrt(criterion(real, upscaled_prev_rec_img))
                         self.config.noise_amp = self.config.noise_amp_init * rmse
                         padded_rec_img = image_pad(upscaled_prev_rec_img)
                 else:
-                    upscaled_prev_random_img = self.draw_sequentially('rand', noise_pad, image_pad)
-                    padded_random_img = image_pad(upscaled_prev_random_img)
+                    with prof.phase('draw_sequentially'):
+                        upscaled_prev_random_img = self.draw_prev_random_img(epoch, noise_pad, image_pad, batch_size)
+                        padded_random_img = image_pad(upscaled_prev_random_img)
 
                 # Make random image input
                 if not self.Gs:
@@ -153,22 +219,31 @@ class SinGAN:
                     padded_random_img_with_z = (self.config.noise_amp * padded_random_z) + padded_random_img
 
                 # Train with fake data
-                fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
-                fake_prob_out = cur_discriminator(fake.detach())
-                d_fake_loss = fake_prob_out.mean()                          # Minimize D(G(z))
-                d_fake_loss.backward(retain_graph=True)
-                D_G_z = d_fake_loss.item()
-
-                # Gradient penalty
-                gradient_penalty = calcul_gp(cur_discriminator, real, fake, self.config.device, False) * self.config.gp_weights
-                gradient_penalty.backward()
-
-                D_optimizer.step()
-                d_loss = d_real_loss + d_fake_loss + gradient_penalty
+                with prof.phase('G_forward'):
+                    fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
+                with prof.phase('D_fake'):
+                    fake_prob_out = cur_discriminator(fake.detach())
+                    d_fake_loss = fake_prob_out.mean()                      # Minimize D(G(z))
+                    d_fake_loss.backward(retain_graph=True)
+                    D_G_z = d_fake_loss.detach()
+
+                # Gradient penalty (only every gp_interval critic steps)
+                with prof.phase('gradient_penalty'):
+                    gradient_penalty = lazy_penalty(cur_discriminator, real, fake, self.config.device, critic_step, self.config, False)
+                    critic_step += 1
+                    if gradient_penalty is not None:
+                        gradient_penalty = gradient_penalty * self.config.gp_weights
+                        gradient_penalty.backward()
+
+                with prof.phase('optimizer_step'):
+                    D_optimizer.step()
+                d_loss = d_real_loss + d_fake_loss
                 critic = D_x - D_G_z
-                self.log_losses[f'{len(self.Gs)}th_D/d'] = d_loss.item()
+                if gradient_penalty is not None:
+                    d_loss = d_loss + gradient_penalty
+                    self.log_losses[f'{len(self.Gs)}th_D/d_gp'] = gradient_penalty.detach()
+                self.log_losses[f'{len(self.Gs)}th_D/d'] = d_loss.detach()
                 self.log_losses[f'{len(self.Gs)}th_D/d_critic'] = critic
-                self.log_losses[f'{len(self.Gs)}th_D/d_gp'] = gradient_penalty.item()
 
             # Train Generator : Maximize D(G(z)) -> Minimize -D(G(z))
             for i in range(self.config.generator_iter):
@@ -181,50 +256,82 @@ class SinGAN:
                 # fake = cur_generator(padded_random_img_with_z.detach(), padded_random_img)
 
                 # Adversarial loss
-                fake_prob_out = cur_discriminator(fake)
-                g_adv_loss = -fake_prob_out.mean()
-                g_adv_loss.backward(retain_graph=True)
-                g_adv_loss = g_adv_loss.item()
+                with prof.phase('G_adversarial'):
+                    fake_prob_out = cur_discriminator(fake)
+                    g_adv_loss = -fake_prob_out.mean()
+                    g_adv_loss.backward(retain_graph=True)
+                    g_adv_loss = g_adv_loss.detach()
 
                 # Reconstruction loss
-                mse_criterion = nn.MSELoss()
-                padded_rec_img_with_z = self.config.noise_amp * padded_rec_z + padded_rec_img
-                g_rec_loss = self.config.rec_weights * mse_criterion(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img), real)
-                g_rec_loss.backward(retain_graph=True)
-                g_rec_loss = g_rec_loss.item()
-
-                G_optimizer.step()
+                with prof.phase('G_reconstruction'):
+                    mse_criterion = nn.MSELoss()
+                    padded_rec_img_with_z = self.config.noise_amp * padded_rec_z + padded_rec_img
+                    g_rec_loss = self.config.rec_weights * mse_criterion(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img), real)
+                    g_rec_loss.backward(retain_graph=True)
+                    g_rec_loss = g_rec_loss.detach()
+
+                with prof.phase('optimizer_step'):
+                    G_optimizer.step()
                 g_loss = g_adv_loss + (self.config.rec_weights * g_rec_loss)
                 self.log_losses[f'{len(self.Gs)}th_G/g'] = g_loss
                 self.log_losses[f'{len(self.Gs)}th_G/g_critic'] = -g_adv_loss
                 self.log_losses[f'{len(self.Gs)}th_G/g_rec'] = g_rec_loss
 
-            # Log losses
-            for key, value in self.log_losses.items():
-                self.writer.add_scalar(key, value, epoch)
-            self.log_losses = {}
+            # Log losses (kept on device, written every log_flush_iter epochs)
+            with prof.phase('logging'):
+                self.metrics.log(self.log_losses, epoch)
+                self.log_losses = {}
 
             # Log image
             if epoch % self.config.img_save_iter == 0 or epoch == (self.config.num_iter - 1):
-                plt.imsave(f'{self.config.result_dir}/{epoch}_fake_sample.png', torch2np(fake.detach()), vmin=0, vmax=1)
-                plt.imsave(f'{self.config.result_dir}/{epoch}_fixed_noise.png', torch2np(padded_rec_img_with_z.detach() * 2 - 1), vmin=0, vmax=1)
-                plt.imsave(f'{self.config.result_dir}/{epoch}_reconstruction.png', torch2np(cur_generator(padded_rec_img_with_z.detach(), padded_rec_img).detach()), vmin=0, vmax=1)
+                with prof.phase('image_saving'):
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_fake_sample.png', fake.detach())
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_fixed_noise.png', padded_rec_img_with_z.detach() * 2 - 1)
+                    self.image_writer.save(f'{self.config.result_dir}/{epoch}_reconstruction.png', cur_generator(padded_rec_img_with_z.detach(), padded_rec_img).detach())
 
             D_scheduler.step()
             G_scheduler.step()
 
+            if self.config.checkpoint_iter and (epoch + 1) % self.config.checkpoint_iter == 0:
+                with prof.phase('checkpoint'):
+                    self.metrics.flush()
+                    atomic_save({'scale': len(self.Gs), 'epoch': epoch, 'critic_step': critic_step,
+                                 'generator': cur_generator.state_dict(), 'discriminator': cur_discriminator.state_dict(),
+                                 'G_optimizer': G_optimizer.state_dict(), 'D_optimizer': D_optimizer.state_dict(),
+                                 'G_scheduler': G_scheduler.state_dict(), 'D_scheduler': D_scheduler.state_dict(),
+                                 'rng': rng_state(), 'rec_z': rec_z, 'padded_rec_img': padded_rec_img,
+                                 'first_img_input': self.first_img_input, 'noise_amp': self.config.noise_amp},
+                                checkpoint_path(self.config))
+
+        if self.prior_sampler is not None:
+            self.prior_sampler.close()
+            stats = self.prior_sampler.stats()
+            print(f'{len(self.Gs)}th GAN {type(self.prior_sampler).__name__}: ' + ', '.join(f'{k}={round(v, 2)}' for k, v in stats.items()))
+            for key, value in stats.items():
+                self.metrics.scalar(f'{self.prior_sampler.tag}/{key}', value, len(self.Gs))
+            self.prior_sampler = None
+
         # Save model weights
-        torch.save(cur_generator.state_dict(), f'{self.config.result_dir}/generator.pth')
-        torch.save(cur_discriminator.state_dict(), f'{self.config.result_dir}/discriminator.pth')
+        atomic_save(cur_generator.state_dict(), f'{self.config.result_dir}/generator.pth')
+        atomic_save(cur_discriminator.state_dict(), f'{self.config.result_dir}/discriminator.pth')
 
         return padded_rec_z, cur_generator
 
-    def draw_sequentially(self, mode, m_noise, m_image):
+    def draw_prev_random_img(self, epoch, m_noise, m_image, num_samples=1):
+        if self.prior_sampler is not None:
+            return self.prior_sampler.get(epoch, num_samples)
+        return self.draw_sequentially('rand', m_noise, m_image, num_samples)
+
+    def sampling_generators(self):
+        # Frozen generators used for sampling, with their BatchNorms folded into the convs
+        return fuse_generators(self.Gs) if self.config.fuse_generators else self.Gs
+
+    def draw_sequentially(self, mode, m_noise, m_image, num_samples=1, generator=None):
         upscaled_prev = self.first_img_input
         if len(self.Gs) > 0:
             if mode == 'rec':
                 count = 0
-                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.Gs, self.Zs, self.reals, self.reals[1:], self.noise_amps):
+                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.sampling_generators(), self.Zs, self.reals, self.reals[1:], self.noise_amps):
                     upscaled_prev = upscaled_prev[:, :, 0:cur_real.shape[2], 0:cur_real.shape[3]]
                     padded_img = m_image(upscaled_prev)
                     padded_img_with_z = noise_amp * padded_rec_z + padded_img
@@ -235,12 +342,12 @@ class SinGAN:
             elif mode == 'rand':
                 count = 0
                 pad_noise = int(((self.config.kernel_size - 1) * self.config.num_layers) / 2)
-                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.Gs, self.Zs, self.reals, self.reals[1:], self.noise_amps):
+                for G, padded_rec_z, cur_real, next_real, noise_amp in zip(self.sampling_generators(), self.Zs, self.reals, self.reals[1:], self.noise_amps):
                     if count == 0:  # Generate random 1-channel noise
-                        random_noise = generate_noise([1, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], device=self.config.device)
-                        random_noise = random_noise.expand(1, 3, random_noise.shape[2], random_noise.shape[3])
+                        random_noise = generate_noise([1, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], num_samples, device=self.config.device, generator=generator)
+                        random_noise = random_noise.expand(num_samples, 3, random_noise.shape[2], random_noise.shape[3])
                     else:           # Generate random 3-channel noise
-                        random_noise = generate_noise([self.config.img_channel, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], device=self.config.device)
+                        random_noise = generate_noise([self.config.img_channel, padded_rec_z.shape[2] - 2 * pad_noise, padded_rec_z.shape[3] - 2 * pad_noise], num_samples, device=self.config.device, generator=generator)
                     padded_noise = m_noise(random_noise)
                     upscaled_prev = upscaled_prev[:, :, 0:cur_real.shape[2], 0:cur_real.shape[3]]
                     padded_img = m_image(upscaled_prev)
@@ -252,11 +359,15 @@ class SinGAN:
         return upscaled_prev
 
     def load_trained_weights(self):
-        if os.path.exists(self.config.exp_dir):
-            self.Gs = torch.load(f'{self.config.exp_dir}/Gs.pth')
-            self.Zs = torch.load(f'{self.config.exp_dir}/Zs.pth')
-            self.noise_amps = torch.load(f'{self.config.exp_dir}/noiseAmp.pth')
-            self.reals = torch.load(f'{self.config.exp_dir}/reals.pth')
+        if os.path.exists(f'{self.config.exp_dir}/model.pt'):
+            # Memory-mapped artifact, generators are built on first access
+            artifact = load_artifact(f'{self.config.exp_dir}/model.pt', self.config)
+            self.Gs, self.Zs, self.reals, self.noise_amps = artifact['Gs'], artifact['Zs'], artifact['reals'], artifact['noise_amps']
+        elif os.path.exists(self.config.exp_dir):
+            self.Gs = load(f'{self.config.exp_dir}/Gs.pth')
+            self.Zs = load(f'{self.config.exp_dir}/Zs.pth')
+            self.noise_amps = load(f'{self.config.exp_dir}/noiseAmp.pth')
+            self.reals = load(f'{self.config.exp_dir}/reals.pth')
 
     def create_inference_input(self, gen_start_scale, scale_h, scale_w):
         real = self.reals[gen_start_scale]
@@ -289,55 +400,69 @@ class SinGAN:
 
         return self.reals[0]
 
-    def inference(self, start_img_input):
+    def generate(self, start_img_input, num_samples=None, batch_size=None, all_scales=False, first_sample=None):
+        # Generator API: yields (first sample index, scale index, images) as soon as each chunk is finished
         if start_img_input is None:
             start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
+        num_samples = self.config.num_samples if num_samples is None else num_samples
+        batch_size = self.config.infer_batch_size if batch_size is None else batch_size
+        first_sample = self.config.first_sample if first_sample is None else first_sample
+        # The scripted sampler draws from the torch RNG, keyed noise runs eagerly
+        if self.config.compile_sampler and not all_scales and self.config.noise_seed is None:
+            return sampler_samples(self.pyramid_sampler(start_img_input), len(self.Gs) - 1, num_samples, batch_size,
+                                   first_sample)
+        return stream_samples(self.config, self.reals, self.sampling_generators(), self.Zs, self.noise_amps, start_img_input,
+                              num_samples, batch_size, all_scales, self.sampling_plan(start_img_input), self.prefix_cache,
+                              first_sample)
+
+    def sampling_plan(self, start_img_input):
+        # Shapes, crops and resize operators of every scale, worked out once per sampling geometry
+        key = plan_key(self.config, self.reals, self.Zs, start_img_input)
+        if key not in self.plans:
+            self.plans[key] = PyramidPlan(self.config, self.reals, self.Zs, start_img_input)
+        return self.plans[key]
+
+    def super_resolve(self, iter_num, path):
+        # Streaming alternative to create_sr_inference_input + inference(), writes one SR sample to path
+        with torch.no_grad():
+            super_resolve(self.config, self.sampling_generators()[-1], self.noise_amps[-1], self.reals[-1], iter_num, path)
+
+    def pyramid_sampler(self, start_img_input=None, script=True):
+        # All frozen scales as one (scripted) module, forward(num_samples) -> finest-scale samples
+        if start_img_input is None:
+            start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
+        return build_pyramid_sampler(self.config, self.reals, self.sampling_generators(), self.Zs, self.noise_amps,
+                                     start_img_input, script, self.sampling_plan(start_img_input))
 
-        cur_images = []
-        for idx, (G, Z_opt, noise_amp) in tqdm(enumerate(zip(self.Gs, self.Zs, self.noise_amps))):
-            padding_size = ((self.config.kernel_size - 1) * self.config.num_layers) / 2
-            pad = nn.ZeroPad2d(int(padding_size))
-            output_h = (Z_opt.shape[2] - padding_size * 2) * self.config.scale_h
-            output_w = (Z_opt.shape[3] - padding_size * 2) * self.config.scale_w
-
+    def inference(self, start_img_input):
+        if start_img_input is None:
+            start_img_input = torch.full(self.reals[0].shape, 0, device=self.config.device)
+        self.image_writer = image_writer(self.config)
+        plan = self.sampling_plan(start_img_input)
+        Gs = self.sampling_generators()
+        keys = prefix_keys(plan, Gs, self.Zs, self.noise_amps, start_img_input) \
+            if self.prefix_cache is not None else [None] * len(Gs)
+
+        cur_images = None
+        for idx in tqdm(range(len(Gs))):
             prev_images = cur_images
             cur_images = []
 
-            for i in range(self.config.num_samples):
-                if idx == 0:
-                    random_z = generate_noise([1, output_h, output_w], device=self.config.device)
-                    random_z = random_z.expand(1, 3, random_z.shape[2], random_z.shape[3])
-                    padded_random_z = pad(random_z)
-                else:
-                    random_z = generate_noise([self.config.img_channel, output_h, output_w], device=self.config.device)
-                    padded_random_z = pad(random_z)
-
-                if self.config.use_fixed_noise and idx < self.config.gen_start_scale:
-                    padded_random_z = Z_opt
-
-                if not prev_images:
-                    padded_random_img = pad(start_img_input)
-                else:
-                    prev_img = prev_images[i]
-                    upscaled_prev_random_img = resize_img(prev_img, 1 / self.config.scale_factor, self.config)
-                    if self.config.mode == "train_SR":
-                        padded_random_img = pad(upscaled_prev_random_img)
-                    else:
-                        upscaled_prev_random_img = upscaled_prev_random_img[:, :,
-                                                   0:round(self.config.scale_h * self.reals[idx].shape[2]),
-                                                   0:round(self.config.scale_w * self.reals[idx].shape[3])]
-                        padded_random_img = pad(upscaled_prev_random_img)
-                        padded_random_img = padded_random_img[:, :, 0:padded_random_z.shape[2], 0:padded_random_z.shape[3]]
-                        padded_random_img = upsampling(padded_random_img, padded_random_z.shape[2], padded_random_z.shape[3])
-
-                padded_random_img_with_z = noise_amp * padded_random_z + padded_random_img
-                cur_image = G(padded_random_img_with_z.detach(), padded_random_img)
+            # Push the samples through this scale in chunks of infer_batch_size
+            for start, num in sample_chunks(self.config.num_samples, self.config.infer_batch_size):
+                prev = None if prev_images is None else prev_images[start:start + num]
+                cur_image = planned_scale(self.config, plan, idx, Gs, self.Zs, self.noise_amps, prev, start_img_input, num,
+                                          self.prefix_cache, keys[idx], self.config.first_sample + start)
 
-                if self.config.save_all_pyramid:
-                    plt.imsave(f'{self.config.infer_dir}/{i}_{idx}.png', torch2np(cur_image.detach()), vmin=0, vmax=1)
-                elif idx == len(self.reals) - 1:
-                    plt.imsave(f'{self.config.infer_dir}/{i}.png', torch2np(cur_image.detach()), vmin=0, vmax=1)
+                for j in range(num):
+                    i = self.config.first_sample + start + j
+                    if self.config.save_all_pyramid:
+                        self.image_writer.save(f'{self.config.infer_dir}/{i}_{idx}.png', cur_image[j:j + 1])
+                    elif idx == len(self.reals) - 1:
+                        self.image_writer.save(f'{self.config.infer_dir}/{i}.png', cur_image[j:j + 1])
 
                 cur_images.append(cur_image)
+            cur_images = torch.cat(cur_images, dim=0)
 
-        return cur_image.detach()
\ No newline at end of file
+        self.image_writer.close()
+        return cur_images[-1:]
@@ -0,0 +1,65 @@
+import weakref
+import threading
+
+import torch
+import torch.nn as nn
+
+from utils.layers import ConvBlock
+from utils.artifact import LazyScales
+
+fused_cache = weakref.WeakKeyDictionary()     # Generator -> FusedGenerator, built once per frozen generator
+fused_cache_lock = threading.Lock()
+
+
+class FusedGenerator(nn.Module):
+    # Inference-only Generator: every ConvBlock is a single conv with the BatchNorm folded in, followed by the
+    # in-place LeakyReLU, so a frozen scale runs num_layers convs and activations and nothing else
+    def __init__(self, body, tail):
+        super(FusedGenerator, self).__init__()
+        self.body = body
+        self.tail = tail
+
+    def forward(self, x, y):    # x:noise, y:prev
+        x = self.body(x)
+        x = self.tail(x)
+        ind = int((y.shape[2] - x.shape[2]) / 2)
+        y = y[:, :, ind:(y.shape[2] - ind), ind:(y.shape[3] - ind)]
+        return x + y
+
+
+def fold_conv_bn(conv, bn):
+    # conv followed by eval-mode bn == one conv with rescaled weights and a shifted bias
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True).to(conv.weight.device, conv.weight.dtype)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+    fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def fuse_generator(G):
+    # Generators still in training mode use batch statistics and cannot be folded
+    if G.training or isinstance(G, FusedGenerator):
+        return G
+    with fused_cache_lock:
+        fused = fused_cache.get(G)
+        if fused is None:
+            layers = []
+            # Building the convs draws random init weights, keep that from shifting the caller's sampling RNG
+            with torch.no_grad(), torch.random.fork_rng(devices=[]):
+                for block in [G.head, *G.body]:
+                    assert isinstance(block, ConvBlock)
+                    layers += [fold_conv_bn(block.conv, block.norm), nn.LeakyReLU(0.2, inplace=True)]
+            fused = FusedGenerator(nn.Sequential(*layers), G.tail).eval()
+            for p in fused.body.parameters():
+                p.requires_grad_(False)
+            fused_cache[G] = fused
+    return fused
+
+
+def fuse_generators(Gs):
+    if isinstance(Gs, LazyScales):
+        # Artifact scales stay lazy, a generator is only built and folded once sampling needs it
+        return LazyScales(lambda idx: fuse_generator(Gs[idx]), len(Gs), Gs.source and Gs.source + ('fused',))
+    return [fuse_generator(G) for G in Gs]
@@ -69,12 +69,12 @@ class AttendModule(nn.Module):
 
     def batch_weighted_avg(self, x, weights):
         b, c, h, w = x.shape
-        # xhat reshape
-        x_reshape = x.view(b * self.num_heads, self.num_c_per_head, h, w)
+        # xhat reshape (reshape, the finest real keeps the channels-last strides of its numpy HWC source)
+        x_reshape = x.reshape(b * self.num_heads, self.num_c_per_head, h, w)
         x_reshape = x_reshape.view(b * self.num_heads, self.num_c_per_head, h * w)
 
         # weight reshape
-        weights_reshape = weights.view(b * self.num_heads, 1, h, w)
+        weights_reshape = weights.reshape(b * self.num_heads, 1, h, w)
         weights_reshape = weights_reshape.view(b * self.num_heads, 1, h * w)
 
         weights_normalized = self.normalize(weights_reshape)
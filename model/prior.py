@@ -0,0 +1,126 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+class PriorImagePool:
+    # Ring buffer of upscaled prior-scale samples for train_single_stage. Filling it is one batched no-grad pass
+    # over the frozen generators instead of a full pyramid pass for every critic/generator step.
+    tag = 'prior_pool'          # Metrics namespace of stats()
+
+    def __init__(self, draw, pool_size, refresh_iter, refresh_size=None, chunk_size=32):
+        self.draw = draw                        # draw(num) -> [num, C, H, W] upscaled prior-scale samples
+        self.pool_size = pool_size
+        self.refresh_iter = refresh_iter
+        self.refresh_size = min(refresh_size or pool_size, pool_size)
+        self.chunk_size = chunk_size
+        self.buffer = None
+        self.cursor = 0
+        self.last_refresh = 0
+
+        # Wall-clock bookkeeping to report what the pool saved
+        self.fill_time = 0
+        self.num_filled = 0
+        self.num_served = 0
+        self.direct_draw_time = None
+
+    def fill(self, num):
+        start = time.perf_counter()
+        with torch.no_grad():
+            for first in range(0, num, self.chunk_size):
+                images = self.draw(min(self.chunk_size, num - first))
+                if self.buffer is None:
+                    self.buffer = images.new_empty((self.pool_size,) + tuple(images.shape[1:]))
+                # Overwrite the oldest entries at the ring cursor
+                for image in images:
+                    self.buffer[self.cursor] = image
+                    self.cursor = (self.cursor + 1) % self.pool_size
+                    self.num_filled += 1
+        self.fill_time += time.perf_counter() - start
+
+    def get(self, epoch, num_samples=1):
+        if self.buffer is None:
+            self.time_direct_draw()
+            self.fill(self.pool_size)
+            self.last_refresh = epoch
+        elif self.refresh_iter and epoch - self.last_refresh >= self.refresh_iter:
+            self.fill(self.refresh_size)
+            self.last_refresh = epoch
+
+        self.num_served += num_samples
+        idx = torch.randint(0, self.pool_size, (num_samples,), device=self.buffer.device)
+        return self.buffer[idx]
+
+    def time_direct_draw(self):
+        # Cost of a single un-pooled draw_sequentially('rand'), the baseline the savings are measured against
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.draw(1)
+        self.direct_draw_time = time.perf_counter() - start
+
+    def saved_time(self):
+        if self.direct_draw_time is None:
+            return 0
+        return self.num_served * self.direct_draw_time - self.fill_time
+
+    def stats(self):
+        return {'served': self.num_served, 'filled': self.num_filled, 'fill_sec': self.fill_time,
+                'saved_sec': self.saved_time()}
+
+    def close(self):
+        self.buffer = None
+
+
+class PriorImagePrefetcher:
+    # Producer thread that computes the next upscaled prior-scale sample while the current D/G step runs.
+    # Every get() still returns a fresh sample, the frozen generators of the previous scales are read-only.
+    tag = 'prior_prefetch'      # Metrics namespace of stats()
+
+    def __init__(self, draw, depth, generator=None):
+        self.draw = draw                        # draw(generator) -> [1, C, H, W] upscaled prior-scale sample
+        self.queue = queue.Queue(maxsize=depth)
+        self.generator = generator              # Own RNG so the producer never races the training loop's draws
+        self.stop_event = threading.Event()
+        self.error = None
+        self.num_served = 0
+        self.wait_time = 0
+        self.thread = threading.Thread(target=self.produce, name='prior-prefetcher', daemon=True)
+        self.thread.start()
+
+    def produce(self):
+        try:
+            with torch.no_grad():
+                while not self.stop_event.is_set():
+                    item = self.draw(self.generator)
+                    while not self.stop_event.is_set():
+                        try:
+                            self.queue.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+        except Exception as e:
+            self.error = e
+
+    def get(self, epoch, num_samples=1):
+        start = time.perf_counter()
+        items = []
+        while len(items) < num_samples:
+            try:
+                items.append(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                if not self.thread.is_alive():
+                    raise RuntimeError('Prior prefetcher stopped')
+        self.wait_time += time.perf_counter() - start
+        self.num_served += num_samples
+        return torch.cat(items, dim=0)
+
+    def stats(self):
+        return {'served': self.num_served, 'wait_sec': self.wait_time}
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
@@ -0,0 +1,428 @@
+import threading
+from typing import List
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.image import resize_img, fix_scale_and_size, resize_operator_torch, resize_along_dim_torch
+from utils.utils import generate_noise, generate_keyed_noise, upsampling
+from utils.writer import PNGStripWriter, to_uint8
+
+
+def inference_noise(config, idx, output_h, output_w, num_samples, first_sample=0):
+    # One independent noise map per sample, drawn in the same order as the one-by-one loop so seeds reproduce.
+    # With noise_seed the maps are keyed by sample id instead
+    if config.noise_seed is not None:
+        channels = 1 if idx == 0 else config.img_channel
+        random_z = generate_keyed_noise([channels, output_h, output_w], config.noise_seed,
+                                        range(first_sample, first_sample + num_samples), idx, config.device)
+        return random_z.expand(-1, 3, -1, -1) if idx == 0 else random_z
+
+    noises = []
+    for _ in range(num_samples):
+        if idx == 0:
+            random_z = generate_noise([1, output_h, output_w], device=config.device)
+            random_z = random_z.expand(1, 3, random_z.shape[2], random_z.shape[3])
+        else:
+            random_z = generate_noise([config.img_channel, output_h, output_w], device=config.device)
+        noises.append(random_z)
+    return torch.cat(noises, dim=0)
+
+
+def inference_scale(config, reals, idx, G, Z_opt, noise_amp, prev_images, start_img_input, num_samples, first_sample=0):
+    # Runs scale idx for a [num_samples, C, H, W] batch of previous scale outputs (None at the first scale)
+    padding_size = ((config.kernel_size - 1) * config.num_layers) / 2
+    pad = nn.ZeroPad2d(int(padding_size))
+    output_h = (Z_opt.shape[2] - padding_size * 2) * config.scale_h
+    output_w = (Z_opt.shape[3] - padding_size * 2) * config.scale_w
+
+    padded_random_z = pad(inference_noise(config, idx, output_h, output_w, num_samples, first_sample))
+    if config.use_fixed_noise and idx < config.gen_start_scale:
+        padded_random_z = Z_opt.expand(num_samples, -1, -1, -1)
+
+    if prev_images is None:
+        padded_random_img = pad(start_img_input)
+    else:
+        upscaled_prev_random_img = resize_img(prev_images, 1 / config.scale_factor, config)
+        if config.mode == "train_SR":
+            padded_random_img = pad(upscaled_prev_random_img)
+        else:
+            upscaled_prev_random_img = upscaled_prev_random_img[:, :,
+                                       0:round(config.scale_h * reals[idx].shape[2]),
+                                       0:round(config.scale_w * reals[idx].shape[3])]
+            padded_random_img = pad(upscaled_prev_random_img)
+            padded_random_img = padded_random_img[:, :, 0:padded_random_z.shape[2], 0:padded_random_z.shape[3]]
+            padded_random_img = upsampling(padded_random_img, padded_random_z.shape[2], padded_random_z.shape[3])
+
+    padded_random_img_with_z = noise_amp * padded_random_z + padded_random_img
+    return run_generator(config, G, padded_random_img_with_z.detach(), padded_random_img).detach()
+
+
+def tile_windows(length, tile_size):
+    # (start, size) pairs covering length in steps of tile_size
+    return [(start, min(tile_size, length - start)) for start in range(0, length, tile_size)]
+
+
+def run_generator(config, G, x, y):
+    # G on the whole canvas, or tile by tile with infer_tile_size. The convs are unpadded, so an output tile only
+    # needs its input window grown by the receptive field margin on every side: the input tiles overlap by twice
+    # the margin, read the same noise as the whole canvas and stitch without seams. Only one tile's activations
+    # (nfc channels) are alive at a time
+    tile_size = config.infer_tile_size
+    margin = int(((config.kernel_size - 1) * config.num_layers) / 2)
+    output_h, output_w = x.shape[2] - 2 * margin, x.shape[3] - 2 * margin
+    if not tile_size or (output_h <= tile_size and output_w <= tile_size):
+        return G(x, y)
+    assert config.pad == 0, 'Tiled inference needs generators without layer padding'
+
+    out = None
+    for top, h in tile_windows(output_h, tile_size):
+        for left, w in tile_windows(output_w, tile_size):
+            rows, cols = slice(top, top + h + 2 * margin), slice(left, left + w + 2 * margin)
+            tile = G(x[:, :, rows, cols], y[:, :, rows, cols])
+            if out is None:
+                out = tile.new_empty(tile.shape[0], tile.shape[1], output_h, output_w)
+            out[:, :, top:top + h, left:left + w] = tile
+    return out
+
+
+# Everything inference_scale works out for one scale. region: rows and columns of the upscaled previous image that
+# land in the padded input, interpolate: the padded image is smaller than the noise and still needs the bilinear fit
+ScalePlan = namedtuple('ScalePlan', ['noise_shape', 'padded_shape', 'pad', 'resize_ops', 'crop', 'region', 'interpolate',
+                                     'use_fixed_noise'])
+
+
+def plan_key(config, reals, Zs, start_img_input):
+    # Everything a PyramidPlan depends on
+    return (config.mode, config.gen_start_scale, config.use_fixed_noise, config.scale_h, config.scale_w,
+            config.scale_factor, str(start_img_input.device), tuple(start_img_input.shape),
+            tuple(tuple(Z_opt.shape) for Z_opt in Zs), tuple(tuple(real.shape) for real in reals))
+
+
+class PyramidPlan:
+    # Immutable description of inference at one geometry: per-scale noise shapes, padding, crop windows and resize
+    # operators, worked out from the shapes alone. Sampling with a plan only executes it, into input buffers that are
+    # allocated once per (scale, chunk size, thread) and reused by every later call. A buffer is only used within one
+    # planned_scale call and never returned, so interleaved generate() streams can share a plan, and so can threads
+    def __init__(self, config, reals, Zs, start_img_input):
+        padding_size = ((config.kernel_size - 1) * config.num_layers) / 2
+        pad = int(padding_size)
+        self.device, self.dtype = config.device, torch.get_default_dtype()     # Where generate_noise draws
+        self.start_shape = tuple(start_img_input.shape)
+
+        scales = []
+        prev_shape = None
+        for idx, Z_opt in enumerate(Zs):
+            noise_h = round((Z_opt.shape[2] - padding_size * 2) * config.scale_h)
+            noise_w = round((Z_opt.shape[3] - padding_size * 2) * config.scale_w)
+            noise_shape = (1 if idx == 0 else config.img_channel, noise_h, noise_w)
+            padded_shape = (noise_h + 2 * pad, noise_w + 2 * pad)
+
+            resize_ops, crop = (), None
+            if prev_shape is None:
+                image_shape = self.start_shape[2:]
+            else:
+                scale_factor, output_shape = fix_scale_and_size(prev_shape, None, 1 / config.scale_factor)
+                antialiasing = scale_factor[0] < 1
+                for dim in np.argsort(np.array(scale_factor)).tolist():
+                    if scale_factor[dim] == 1.0:
+                        continue
+                    weights, fov = resize_operator_torch(prev_shape[dim], output_shape[dim], scale_factor[dim], None,
+                                                         antialiasing, self.device, self.dtype)
+                    resize_ops += ((dim + 2, weights, fov),)
+                image_shape = tuple(int(length) for length in output_shape)
+                if config.mode != "train_SR":
+                    crop = (round(config.scale_h * reals[idx].shape[2]), round(config.scale_w * reals[idx].shape[3]))
+                    image_shape = (min(image_shape[0], crop[0]), min(image_shape[1], crop[1]))
+
+            if crop is None:
+                region, interpolate = image_shape, False
+            else:
+                # pad, then cut to the noise size, then bilinear up to it when the image falls short
+                region = (min(image_shape[0], padded_shape[0] - pad), min(image_shape[1], padded_shape[1] - pad))
+                interpolate = region[0] + 2 * pad < padded_shape[0] or region[1] + 2 * pad < padded_shape[1]
+
+            scales.append(ScalePlan(noise_shape, padded_shape, pad, resize_ops, crop, region, interpolate,
+                                    bool(config.use_fixed_noise and idx < config.gen_start_scale)))
+            prev_shape = (noise_h, noise_w)
+        self.scales = tuple(scales)
+        self.local = threading.local()
+
+    def scale_buffers(self, idx, num_samples):
+        # (noise, padded noise, padded image, generator input) of the calling thread, the zero borders are never written
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+        key = (idx, num_samples)
+        if key not in buffers:
+            scale = self.scales[idx]
+            C = self.start_shape[1]
+            new = lambda *shape: torch.zeros(shape, device=self.device, dtype=self.dtype)
+            buffers[key] = (new(num_samples, *scale.noise_shape),
+                            new(num_samples, C, *scale.padded_shape),
+                            new(self.start_shape[0] if idx == 0 else num_samples, C, *scale.padded_shape),
+                            new(num_samples, C, *scale.padded_shape))
+        return buffers[key]
+
+
+class PrefixCache:
+    # Size-bounded LRU of scale outputs that cannot change between calls: with use_fixed_noise every scale below
+    # gen_start_scale only sees Z_opt, so the whole prefix of the pyramid is the same for every sample. Entries keep
+    # the objects their key identifies alive, so an id in a key is never reused while the entry exists
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()            # key -> (output, size, referenced objects)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build, refs):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = build()
+        size = value.element_size() * value.nelement()
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = (value, size, refs)
+                self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+def prefix_keys(plan, Gs, Zs, noise_amps, start_img_input):
+    # PrefixCache key of every fixed-noise scale (None for the random ones) and the objects it identifies. A scale's
+    # output depends on the start image and on every scale up to it, so all of them are part of its key. The start
+    # image is a small coarsest-scale tensor that callers rebuild on every call, so it goes in by value. Scales loaded
+    # from an artifact are named by their payload, so looking them up builds nothing
+    start = start_img_input.detach().cpu().numpy().tobytes()
+    keys, identity, refs = [], (id(plan), start), [plan]
+    for idx, scale in enumerate(plan.scales):
+        if not scale.use_fixed_noise:
+            keys.append(None)
+            continue
+        payload = tuple(getattr(scales, 'identity', lambda idx: None)(idx) for scales in (Gs, Zs, noise_amps))
+        if None not in payload:
+            identity += payload
+        else:
+            G, Z_opt = Gs[idx], Zs[idx]
+            identity += (id(G), tuple(p._version for p in G.parameters()), id(Z_opt), Z_opt._version, float(noise_amps[idx]))
+            refs += [G, Z_opt]
+        keys.append((identity, tuple(refs)))
+    return keys
+
+
+@torch.no_grad()
+def planned_scale(config, plan, idx, Gs, Zs, noise_amps, prev_images, start_img_input, num_samples, cache=None,
+                  cache_key=None, first_sample=0):
+    # inference_scale driven by a PyramidPlan: same noise draws and the same arithmetic, so the same samples.
+    # Fixed-noise scales come from cache when prefix_keys gave them a key. Gs, Zs and noise_amps are the per-scale
+    # lists, only indexed when scale idx actually runs
+    scale = plan.scales[idx]
+    noise = plan.scale_buffers(idx, num_samples)[0]
+
+    # One draw per sample, like generate_noise. Cached scales still draw, so seeds keep lining up. Keyed noise does
+    # not depend on the draws before it and is only made for the scales that use it
+    if config.noise_seed is None:
+        for j in range(num_samples):
+            noise[j:j + 1].normal_()
+    elif not scale.use_fixed_noise:
+        noise.copy_(generate_keyed_noise(scale.noise_shape, config.noise_seed,
+                                         range(first_sample, first_sample + num_samples), idx, noise.device))
+    if cache is not None and cache_key is not None:
+        identity, refs = cache_key
+        build = lambda: run_planned_scale(config, plan, idx, Gs, Zs, noise_amps, prev_images, start_img_input, num_samples)
+        return cache.get((identity, num_samples), build, refs)
+    return run_planned_scale(config, plan, idx, Gs, Zs, noise_amps, prev_images, start_img_input, num_samples)
+
+
+def run_planned_scale(config, plan, idx, Gs, Zs, noise_amps, prev_images, start_img_input, num_samples):
+    # Everything of planned_scale after the noise draws
+    scale = plan.scales[idx]
+    noise, padded_random_z, padded_random_img, padded_random_img_with_z = plan.scale_buffers(idx, num_samples)
+    p = scale.pad
+    h, w = scale.noise_shape[1:]
+
+    padded_random_z[:, :, p:p + h, p:p + w].copy_(noise)
+    if scale.use_fixed_noise:
+        padded_random_z = Zs[idx].expand(num_samples, -1, -1, -1)
+
+    if prev_images is None:
+        padded_random_img[:, :, p:p + h, p:p + w].copy_(start_img_input)
+    else:
+        upscaled = prev_images
+        for dim, weights, fov in scale.resize_ops:
+            upscaled = resize_along_dim_torch(upscaled, dim, weights, fov)
+        rows, cols = scale.region
+        if scale.interpolate:
+            image = F.pad(upscaled[:, :, 0:rows, 0:cols].clamp(-1, 1), [p, p, p, p])[:, :, 0:scale.padded_shape[0], 0:scale.padded_shape[1]]
+            padded_random_img = upsampling(image, scale.padded_shape[0], scale.padded_shape[1])
+        else:
+            padded_random_img[:, :, p:p + rows, p:p + cols].copy_(upscaled[:, :, 0:rows, 0:cols]).clamp_(-1, 1)
+
+    torch.mul(padded_random_z, noise_amps[idx], out=padded_random_img_with_z)
+    padded_random_img_with_z.add_(padded_random_img)
+    return run_generator(config, Gs[idx], padded_random_img_with_z, padded_random_img).detach()
+
+
+def super_resolve(config, G, noise_amp, real, iter_num, path):
+    # train_SR inference for one sample as a stream: the finest generator runs iter_num times at growing sizes with
+    # only the current level alive, every level runs tile by tile with infer_tile_size, and the last one is written
+    # to path in row strips. Same noise and output as inference() on the create_sr_inference_input pyramid with
+    # num_samples=1, without keeping any of its levels
+    padding_size = int(((config.kernel_size - 1) * config.num_layers) / 2)
+    pad = nn.ZeroPad2d(padding_size)
+
+    image = real
+    for idx in range(iter_num):
+        image = resize_img(image, 1 / config.scale_factor, config)
+        padded_random_img = pad(image)
+        padded_random_z = pad(inference_noise(config, idx, image.shape[2], image.shape[3], 1))
+        if config.use_fixed_noise and idx < config.gen_start_scale:
+            padded_random_z = torch.zeros_like(padded_random_z)      # create_sr_inference_input's Zs are all zeros
+        padded_random_img_with_z = noise_amp * padded_random_z + padded_random_img
+        del padded_random_z, image
+
+        if idx < iter_num - 1:
+            image = run_generator(config, G, padded_random_img_with_z, padded_random_img)
+            continue
+
+        # Finest level: one band of tile rows at a time straight to the PNG
+        output_h, output_w = padded_random_img.shape[2] - 2 * padding_size, padded_random_img.shape[3] - 2 * padding_size
+        png = PNGStripWriter(path, output_h, output_w)
+        for top, h in tile_windows(output_h, config.infer_tile_size or output_h):
+            rows = slice(top, top + h + 2 * padding_size)
+            png.write(to_uint8(run_generator(config, G, padded_random_img_with_z[:, :, rows], padded_random_img[:, :, rows])))
+        png.close()
+
+
+def sample_chunks(num_samples, batch_size):
+    # (first sample index, chunk size) pairs covering num_samples. inference() draws a scale's noise for every sample
+    # before the next scale and keyed noise has no draw order, so neither depends on the chunking. Conv kernels picked
+    # per batch size do, so samples match other chunk sizes to ~1e-6 rather than bit for bit. stream_samples walks the
+    # whole pyramid per chunk: with the torch RNG its samples change with the batch size
+    batch_size = max(1, batch_size or num_samples)
+    return [(start, min(batch_size, num_samples - start)) for start in range(0, num_samples, batch_size)]
+
+
+def stream_samples(config, reals, Gs, Zs, noise_amps, start_img_input, num_samples, batch_size, all_scales=False, plan=None,
+                   cache=None, first_sample=0):
+    # Walks the whole pyramid for one chunk of samples before starting the next one, so memory is bounded by a
+    # single chunk no matter how many samples are requested. Yields (first sample index, scale index, images)
+    # for the finest scale, or for every scale with all_scales. Sample indices start at first_sample
+    plan = plan or PyramidPlan(config, reals, Zs, start_img_input)
+    keys = prefix_keys(plan, Gs, Zs, noise_amps, start_img_input) if cache is not None else [None] * len(Gs)
+    for start, num in sample_chunks(num_samples, batch_size):
+        cur_image = None
+        for idx in range(len(Gs)):
+            cur_image = planned_scale(config, plan, idx, Gs, Zs, noise_amps, cur_image, start_img_input, num, cache, keys[idx],
+                                      first_sample + start)
+            if all_scales or idx == len(Gs) - 1:
+                yield first_sample + start, idx, cur_image
+
+
+def sampler_samples(sampler, last_idx, num_samples, batch_size, first_sample=0):
+    # Same (first sample index, scale index, images) stream as stream_samples, from a PyramidSampler
+    with torch.no_grad():
+        for start, num in sample_chunks(num_samples, batch_size):
+            yield first_sample + start, last_idx, sampler(num)
+
+
+class PyramidStage(nn.Module):
+    # One frozen scale of inference_scale with every shape, crop and resize operator fixed up front, so the whole
+    # pyramid can be scripted. Noise is drawn per sample in the same order as inference_noise
+    resize_dims: List[int]
+    resize_weights: List[torch.Tensor]
+    resize_fovs: List[torch.Tensor]
+
+    def __init__(self, G, noise_amp, Z_opt, first, use_fixed_noise, noise_shape, pad, crop, resize_ops):
+        super(PyramidStage, self).__init__()
+        self.G = G
+        self.noise_amp = float(noise_amp)
+        # Trained models keep the zero reconstruction noise of scales >= 1 as int64, noise is drawn like generate_noise
+        self.register_buffer('Z_opt', Z_opt.to(torch.get_default_dtype()))
+        self.first = first                      # Coarsest scale: 1-channel noise and the start image as input
+        self.use_fixed_noise = use_fixed_noise
+        self.noise_shape = noise_shape          # [C, H, W] of one noise map before padding
+        self.pad = pad
+        self.crop = crop                        # [H, W] crop of the upscaled previous image, [-1, -1]: none (SR)
+        self.resize_dims = [dim for dim, _, _ in resize_ops]
+        self.resize_weights = [weights for _, weights, _ in resize_ops]
+        self.resize_fovs = [fov for _, _, fov in resize_ops]
+
+    def noise(self, num_samples: int):
+        noises = []
+        for _ in range(num_samples):
+            z = torch.randn([1] + self.noise_shape, device=self.Z_opt.device, dtype=self.Z_opt.dtype)
+            if self.first:
+                z = z.expand(1, 3, z.shape[2], z.shape[3])
+            noises.append(z)
+        z = F.pad(torch.cat(noises, dim=0), [self.pad, self.pad, self.pad, self.pad])
+        if self.use_fixed_noise:
+            z = self.Z_opt.expand(num_samples, -1, -1, -1)
+        return z
+
+    def forward(self, prev, num_samples: int):
+        padded_random_z = self.noise(num_samples)
+        if self.first:
+            padded_random_img = F.pad(prev, [self.pad, self.pad, self.pad, self.pad])
+        else:
+            upscaled = prev
+            for i in range(len(self.resize_dims)):
+                upscaled = resize_along_dim_torch(upscaled, self.resize_dims[i], self.resize_weights[i], self.resize_fovs[i])
+            upscaled = upscaled.clamp(-1, 1)
+            if self.crop[0] < 0:
+                padded_random_img = F.pad(upscaled, [self.pad, self.pad, self.pad, self.pad])
+            else:
+                upscaled = upscaled[:, :, 0:self.crop[0], 0:self.crop[1]]
+                padded_random_img = F.pad(upscaled, [self.pad, self.pad, self.pad, self.pad])
+                padded_random_img = padded_random_img[:, :, 0:padded_random_z.shape[2], 0:padded_random_z.shape[3]]
+                padded_random_img = F.interpolate(padded_random_img, size=[padded_random_z.shape[2], padded_random_z.shape[3]],
+                                                  mode='bilinear', align_corners=True)
+        return self.G(self.noise_amp * padded_random_z + padded_random_img, padded_random_img)
+
+
+class PyramidSampler(nn.Module):
+    # All frozen scales as one module: forward(num_samples) -> [num_samples, C, H, W] finest-scale samples.
+    # Scripted it runs without the Python loop of inference() and can be saved with torch.jit.save
+    def __init__(self, stages, start_img_input):
+        super(PyramidSampler, self).__init__()
+        self.stages = nn.ModuleList(stages)
+        self.register_buffer('start_img_input', start_img_input)
+
+    def forward(self, num_samples: int):
+        x = self.start_img_input
+        for stage in self.stages:
+            x = stage(x, num_samples)
+        return x
+
+
+def build_pyramid_sampler(config, reals, Gs, Zs, noise_amps, start_img_input, script=True, plan=None):
+    plan = plan or PyramidPlan(config, reals, Zs, start_img_input)
+    stages = []
+    for idx, (G, Z_opt, noise_amp, scale) in enumerate(zip(Gs, Zs, noise_amps, plan.scales)):
+        stages.append(PyramidStage(G, noise_amp, Z_opt, idx == 0, scale.use_fixed_noise, list(scale.noise_shape), scale.pad,
+                                   list(scale.crop or (-1, -1)), list(scale.resize_ops)))
+    sampler = PyramidSampler(stages, start_img_input).eval()
+    return torch.jit.script(sampler) if script else sampler
@@ -0,0 +1,19 @@
+import torch
+
+from model.modules.acm_module import AttendModule
+
+
+def test_attend_module_accepts_channels_last_input():
+    # The finest real image comes from a numpy HWC array, so conv features of it are channels-last
+    torch.manual_seed(0)
+    attend = AttendModule(32, num_heads=8)
+    attend.init_parameters()
+    x = torch.randn(2, 32, 13, 11)
+    x_last = x.contiguous(memory_format=torch.channels_last)
+    assert not x_last.is_contiguous()
+
+    with torch.no_grad():
+        mus, weights = attend(x)
+        mus_last, weights_last = attend(x_last)
+    torch.testing.assert_close(mus_last, mus)
+    torch.testing.assert_close(weights_last, weights)
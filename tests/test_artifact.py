@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from config import Config
+from model.ACM_SinGAN import SinGAN_ACM
+from model.generator import Generator
+from utils.artifact import save_artifact
+from utils.checkpoint import load_finished_scales
+from utils.layers import weights_init
+
+
+class ArtifactConfig(Config):
+    device = torch.device('cpu')
+    resume = True
+
+
+def saved_artifact(exp_dir, sizes=((25, 30), (33, 40)), Ds=None):
+    # model.pt of a finished run, without the per-scale pickles
+    ArtifactConfig.exp_dir = str(exp_dir)
+    pad = int(((ArtifactConfig.kernel_size - 1) * ArtifactConfig.num_layers) / 2)
+    torch.manual_seed(0)
+    Gs, Zs, reals = [], [], []
+    for h, w in sizes:
+        G = Generator(ArtifactConfig)
+        G.apply(weights_init)
+        Gs.append(G.eval())
+        reals.append(torch.rand(1, 3, h, w) * 2 - 1)
+        Zs.append(torch.nn.functional.pad(torch.randn(1, 3, h, w), [pad] * 4))
+    scale_nfcs = [(ArtifactConfig.nfc, ArtifactConfig.min_nfc)] * len(sizes)
+    noise_amps = [1.0] + [0.1] * (len(sizes) - 1)
+    save_artifact(f'{exp_dir}/model.pt', Gs, Zs, reals, noise_amps, scale_nfcs, ArtifactConfig, Ds=Ds)
+    return Gs, Zs, reals
+
+
+def test_finished_run_resumes_from_model_pt(tmp_path):
+    Gs, Zs, _ = saved_artifact(tmp_path)
+    loaded_Gs, loaded_Zs, noise_amps = load_finished_scales(ArtifactConfig, ['Gs', 'Zs', 'noiseAmp'])
+    assert len(loaded_Gs) == len(Gs)
+    assert all(torch.equal(loaded, Z) for loaded, Z in zip(loaded_Zs, Zs))
+    assert [float(amp) for amp in noise_amps] == pytest.approx([1.0, 0.1])
+
+
+def test_acm_resume_from_model_pt_without_ds_fails_clearly(tmp_path):
+    saved_artifact(tmp_path)
+    with pytest.raises(Exception, match='no discriminators'):
+        load_finished_scales(ArtifactConfig, ['Gs', 'Ds', 'Zs', 'noiseAmp', 'reals'])
+
+
+def test_cached_scales_of_a_loaded_artifact_are_not_built(tmp_path):
+    class SamplingConfig(ArtifactConfig):
+        mode = 'train'
+        scale_factor = 0.75
+        use_fixed_noise = True
+        gen_start_scale = 2
+        save_attention_map = False
+        compile_sampler = False
+    saved_artifact(tmp_path, sizes=((25, 30), (33, 40), (44, 53)))
+    model = SinGAN_ACM(SamplingConfig)
+    model.load_trained_weights()
+    first = [images for _, _, images in model.generate(None, num_samples=2, batch_size=2)]
+    assert model.Gs.materialized() == [0, 1, 2]
+
+    # Reloading names the same payload, so the fixed-noise scales 0 and 1 come from the warm prefix cache
+    model.load_trained_weights()
+    second = [images for _, _, images in model.generate(None, num_samples=2, batch_size=2)]
+    assert model.Gs.materialized() == [2]
+    assert model.prefix_cache.info()['hits'] == 2
+    assert second[0].shape == first[0].shape
@@ -0,0 +1,79 @@
+import os
+import time
+
+import numpy as np
+import torch
+from skimage import io
+
+import utils.cache
+from config import Config
+from utils.cache import pyramid_cache_key, load_pyramid, save_pyramid, remove_stale_entries
+
+
+class CacheConfig(Config):
+    scale_factor = 0.75
+    start_scale = 1
+    stop_scale = 2
+
+
+def cached_image(tmp_path):
+    CacheConfig.img_path = str(tmp_path / 'img.png')
+    io.imsave(CacheConfig.img_path, (np.random.RandomState(0).rand(30, 25, 3) * 255).astype('uint8'), check_contrast=False)
+    return CacheConfig
+
+
+def pyramid():
+    return [torch.rand(1, 3, 19, 23), torch.rand(1, 3, 25, 30)]
+
+
+def test_pyramid_cache_miss_then_hit(tmp_path):
+    config = cached_image(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    key, image_hash, fields = pyramid_cache_key(config)
+    assert load_pyramid(cache_dir, key, 'cpu') is None
+
+    reals = pyramid()
+    save_pyramid(cache_dir, key, reals, image_hash, fields)
+    cached = load_pyramid(cache_dir, key, 'cpu')
+    assert len(cached) == len(reals)
+    for real, level in zip(reals, cached):
+        assert torch.equal(level, real)
+
+
+def test_pyramid_cache_key_follows_resize_version(tmp_path, monkeypatch):
+    config = cached_image(tmp_path)
+    key = pyramid_cache_key(config)[0]
+    monkeypatch.setattr(utils.cache, 'RESIZE_VERSION', utils.cache.RESIZE_VERSION + 1)
+    assert pyramid_cache_key(config)[0] != key
+
+
+def test_invalid_entry_is_renamed_and_removed_once_stale(tmp_path):
+    config = cached_image(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    key, image_hash, fields = pyramid_cache_key(config)
+    save_pyramid(cache_dir, key, pyramid(), image_hash, fields)
+
+    # Truncated level file: the entry no longer loads and the next save replaces it
+    level_path = os.path.join(cache_dir, key, 'level_0.npy')
+    with open(level_path, 'r+b') as f:
+        f.truncate(64)
+    assert load_pyramid(cache_dir, key, 'cpu') is None
+    reals = pyramid()
+    save_pyramid(cache_dir, key, reals, image_hash, fields)
+    assert torch.equal(load_pyramid(cache_dir, key, 'cpu')[0], reals[0])
+
+    stale = [name for name in os.listdir(cache_dir) if '-stale-' in name]
+    assert len(stale) == 1
+
+    # Recently replaced entries may still be mapped by another run and are kept
+    remove_stale_entries(cache_dir)
+    assert stale[0] in os.listdir(cache_dir)
+
+    old = time.time() - 2 * utils.cache.SCRATCH_MAX_AGE
+    os.utime(os.path.join(cache_dir, stale[0]), (old, old))
+    remove_stale_entries(cache_dir)
+    assert sorted(os.listdir(cache_dir)) == [key]
+
+
+def test_remove_stale_entries_without_cache_dir(tmp_path):
+    remove_stale_entries(str(tmp_path / 'missing'))
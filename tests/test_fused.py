@@ -0,0 +1,36 @@
+import torch
+
+from config import Config
+from model.fused import fuse_generator
+from model.generator import Generator
+from utils.layers import weights_init
+
+
+def frozen_generator():
+    torch.manual_seed(0)
+    G = Generator(Config)
+    G.apply(weights_init)
+    # Non-trivial running statistics, like a trained generator
+    for module in G.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.normal_(0, 0.5)
+            module.running_var.uniform_(0.2, 2)
+            module.weight.data.normal_(1, 0.2)
+            module.bias.data.normal_(0, 0.2)
+    return G.eval()
+
+
+def test_fused_generator_matches_original():
+    G = frozen_generator()
+    x = torch.randn(4, 3, 46, 57)
+    y = torch.rand(4, 3, 46, 57) * 2 - 1
+    with torch.no_grad():
+        expected = G(x, y)
+        fused = fuse_generator(G)(x, y)
+    # Folding reorders the float arithmetic, so the outputs agree to a tolerance and not bit for bit
+    torch.testing.assert_close(fused, expected, rtol=0, atol=1e-5)
+
+
+def test_training_generator_is_not_fused():
+    G = frozen_generator().train()
+    assert fuse_generator(G) is G
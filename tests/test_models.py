@@ -0,0 +1,110 @@
+import importlib
+
+import pytest
+import torch
+
+from config import Config
+from model.generator import Generator
+from utils.layers import weights_init
+from utils.utils import generate_keyed_noise
+
+
+class ModelConfig(Config):
+    device = torch.device('cpu')
+    mode = 'train'
+    scale_factor = 0.75
+    gen_start_scale = 0
+    infer_batch_size = 1
+    compile_sampler = False
+    save_all_pyramid = False
+    save_attention_map = False
+
+
+def model_class(name):
+    # model.SinGAN needs torchsummary at import time, model.ACM_SinGAN does not
+    if name == 'SinGAN':
+        pytest.importorskip('torchsummary')
+    module, cls = {'SinGAN': ('model.SinGAN', 'SinGAN'), 'SinGAN_ACM': ('model.ACM_SinGAN', 'SinGAN_ACM')}[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+def trained_like_model(name, config, sizes=((25, 30), (33, 40), (44, 53))):
+    pad = int(((config.kernel_size - 1) * config.num_layers) / 2)
+    torch.manual_seed(0)
+    model = model_class(name)(config)
+    for i, (h, w) in enumerate(sizes):
+        G = Generator(config)
+        G.apply(weights_init)
+        model.Gs.append(G.eval())
+        model.reals.append(torch.rand(1, 3, h, w) * 2 - 1)
+        z = torch.randn(1, 1, h, w).expand(1, 3, h, w) if i == 0 else torch.full([1, 3, h, w], 0)
+        model.Zs.append(torch.nn.functional.pad(z, [pad] * 4))
+        model.noise_amps.append(1.0 if i == 0 else 0.1)
+    return model
+
+
+def generated(model, **kwargs):
+    return torch.cat([images for _, _, images in model.generate(None, **kwargs)], dim=0)
+
+
+@pytest.mark.parametrize('name', ['SinGAN', 'SinGAN_ACM'])
+def test_keyed_sample_can_be_regenerated_alone(name):
+    class KeyedConfig(ModelConfig):
+        noise_seed = 11
+    model = trained_like_model(name, KeyedConfig)
+
+    # Same conv kernels for every batch size, so the only difference left would be the noise
+    with torch.backends.mkldnn.flags(enabled=False):
+        samples = generated(model, num_samples=5, batch_size=5)
+        for k in (0, 3):
+            assert torch.equal(generated(model, num_samples=1, batch_size=1, first_sample=k), samples[k:k + 1])
+
+
+def test_keyed_noise_does_not_depend_on_draw_order():
+    noise = generate_keyed_noise([3, 7, 9], 5, [0, 1, 2, 3], 2, 'cpu')
+    for order in ([3, 1, 0, 2], [2], [1, 3]):
+        assert torch.equal(generate_keyed_noise([3, 7, 9], 5, order, 2, 'cpu'), noise[order])
+    assert not torch.equal(generate_keyed_noise([3, 7, 9], 5, [0], 1, 'cpu'), noise[:1])
+
+
+class CapturingWriter:
+    # Stands in for the background image writer, keeps what inference() saves
+    def __init__(self):
+        self.images = {}
+
+    def save(self, path, image):
+        self.images[path] = image.clone()
+
+    def close(self):
+        pass
+
+
+def inferred(name, config, monkeypatch):
+    model = trained_like_model(name, config)
+    writer = CapturingWriter()
+    monkeypatch.setattr(importlib.import_module(type(model).__module__), 'image_writer', lambda config: writer)
+    model.inference(None)
+    return writer.images
+
+
+@pytest.mark.parametrize('name', ['SinGAN', 'SinGAN_ACM'])
+@pytest.mark.parametrize('batch_size', [2, 3, None])
+def test_chunked_inference_matches_one_sample_at_a_time(name, batch_size, monkeypatch):
+    class OneConfig(ModelConfig):
+        num_samples = 5
+        infer_batch_size = 1
+        infer_dir = 'infer'
+
+    class ChunkedConfig(OneConfig):
+        infer_batch_size = batch_size
+
+    # inference() draws every scale's noise sample by sample before moving on to the next scale, so any chunking
+    # sees the same draws. oneDNN picks conv kernels by batch size, the native kernels make the comparison exact
+    with torch.backends.mkldnn.flags(enabled=False):
+        torch.manual_seed(4)
+        one = inferred(name, OneConfig, monkeypatch)
+        torch.manual_seed(4)
+        chunked = inferred(name, ChunkedConfig, monkeypatch)
+    assert sorted(chunked) == sorted(one) == [f'infer/{i}.png' for i in range(5)]
+    for path in one:
+        assert torch.equal(chunked[path], one[path])
@@ -0,0 +1,36 @@
+import torch
+
+from model.prior import PriorImagePool
+
+
+def counting_draw():
+    # Every drawn sample is filled with its own draw number, so pool entries can be told apart
+    count = [0]
+
+    def draw(num):
+        images = torch.arange(count[0], count[0] + num, dtype=torch.float32).view(num, 1, 1, 1).expand(num, 3, 4, 5)
+        count[0] += num
+        return images
+    return draw
+
+
+def test_pool_refresh_replaces_refresh_size_oldest_entries():
+    pool = PriorImagePool(counting_draw(), pool_size=8, refresh_iter=10, refresh_size=3, chunk_size=2)
+    pool.get(0)
+    # Draw 0 times the baseline, draws 1-8 fill the pool
+    assert pool.buffer[:, 0, 0, 0].tolist() == [1, 2, 3, 4, 5, 6, 7, 8]
+
+    pool.get(9)
+    assert pool.buffer[:, 0, 0, 0].tolist() == [1, 2, 3, 4, 5, 6, 7, 8]
+
+    pool.get(10)
+    assert pool.buffer[:, 0, 0, 0].tolist() == [9, 10, 11, 4, 5, 6, 7, 8]
+    pool.get(20)
+    assert pool.buffer[:, 0, 0, 0].tolist() == [9, 10, 11, 12, 13, 14, 7, 8]
+    assert pool.stats()['filled'] == 8 + 2 * 3
+    assert pool.stats()['served'] == 4
+
+
+def test_pool_stats_are_logged_under_prior_pool():
+    assert PriorImagePool.tag == 'prior_pool'
+    assert set(PriorImagePool(counting_draw(), 4, 0).stats()) == {'served', 'filled', 'fill_sec', 'saved_sec'}
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.image import ResizeOperatorCache, imresize_in, imresize_torch, resize_operator_torch, resize_operators
+
+
+@pytest.mark.parametrize('scale', [0.75, 0.5, 1 / 0.75, 2.3])
+@pytest.mark.parametrize('size', [(25, 31), (33, 17)])
+def test_imresize_torch_matches_imresize_in(scale, size):
+    # Batched torch resize against the numpy one, image by image
+    rng = np.random.RandomState(0)
+    images = rng.uniform(-1, 1, (3, 3) + size)
+    out = imresize_torch(torch.from_numpy(images), scale_factor=scale).numpy()
+    for image, resized in zip(images, out):
+        expected = imresize_in(image.transpose(1, 2, 0), scale_factor=scale).transpose(2, 0, 1)
+        assert resized.shape == expected.shape
+        np.testing.assert_allclose(resized, expected, rtol=0, atol=1e-12)
+
+
+def test_imresize_torch_casts_integer_input():
+    x = torch.randint(-1, 2, (1, 3, 25, 31))
+    out = imresize_torch(x, scale_factor=0.75)
+    assert out.dtype == torch.get_default_dtype()
+    torch.testing.assert_close(out, imresize_torch(x.float(), scale_factor=0.75), rtol=0, atol=0)
+
+
+def operator(length):
+    return torch.zeros(length, 4), torch.zeros(length, 4, dtype=torch.int64)
+
+
+def test_operator_cache_evicts_least_recently_used_by_bytes():
+    # Every operator below is 16 * (4 * 4 + 4 * 8) = 768 bytes, the budget fits two of them
+    cache = ResizeOperatorCache(max_bytes=2 * 768)
+    a = cache.get('a', lambda: operator(16))
+    cache.get('b', lambda: operator(16))
+    assert cache.get('a', lambda: operator(16)) is a
+    cache.get('c', lambda: operator(16))
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.info()['nbytes'] == 2 * 768
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_operator_cache_keeps_an_oversized_operator():
+    cache = ResizeOperatorCache(max_bytes=100)
+    cache.get('a', lambda: operator(16))
+    cache.get('b', lambda: operator(16))
+    assert list(cache.entries) == ['b']
+
+
+def test_operator_cache_keys_separate_devices_and_dtypes():
+    resize_operators.clear()
+    weights32, _ = resize_operator_torch(25, 19, 0.75, None, True, torch.device('cpu'), torch.float32)
+    weights64, _ = resize_operator_torch(25, 19, 0.75, None, True, torch.device('cpu'), torch.float64)
+    weights_meta, _ = resize_operator_torch(25, 19, 0.75, None, True, torch.device('meta'), torch.float32)
+    assert (weights32.dtype, weights64.dtype) == (torch.float32, torch.float64)
+    assert weights_meta.device.type == 'meta'
+    assert resize_operators.info()['entries'] == 3
+    assert resize_operator_torch(25, 19, 0.75, None, True, torch.device('cpu'), torch.float32)[0] is weights32
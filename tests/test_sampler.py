@@ -0,0 +1,104 @@
+import threading
+
+import torch
+
+from config import Config
+from model.generator import Generator
+from model.sampler import PyramidPlan, PrefixCache, build_pyramid_sampler, planned_scale, stream_samples
+from utils.layers import weights_init
+
+
+class SamplerConfig(Config):
+    device = torch.device('cpu')
+    mode = 'train'
+    scale_factor = 0.75
+    use_fixed_noise = True
+    gen_start_scale = 0
+
+
+class KeyedConfig(SamplerConfig):
+    # Keyed noise does not depend on the order samples are drawn in, scale 0 comes from the prefix cache
+    noise_seed = 7
+    gen_start_scale = 1
+
+
+def trained_like_pyramid(sizes=((25, 30), (33, 40), (44, 53))):
+    # Zs as train_single_stage leaves them: 1-channel float noise at scale 0, int64 zeros above
+    pad = int(((SamplerConfig.kernel_size - 1) * SamplerConfig.num_layers) / 2)
+    torch.manual_seed(0)
+    reals, Gs, Zs, noise_amps = [], [], [], []
+    for i, (h, w) in enumerate(sizes):
+        G = Generator(SamplerConfig)
+        G.apply(weights_init)
+        Gs.append(G.eval())
+        reals.append(torch.rand(1, 3, h, w) * 2 - 1)
+        z = torch.randn(1, 1, h, w).expand(1, 3, h, w) if i == 0 else torch.full([1, 3, h, w], 0)
+        Zs.append(torch.nn.functional.pad(z, [pad] * 4))
+        noise_amps.append(1.0 if i == 0 else 0.1)
+    return reals, Gs, Zs, noise_amps
+
+
+def test_sampler_from_int_zs_matches_eager():
+    reals, Gs, Zs, noise_amps = trained_like_pyramid()
+    start = torch.full(reals[0].shape, 0)
+    sampler = build_pyramid_sampler(SamplerConfig, reals, Gs, Zs, noise_amps, start)
+
+    plan = PyramidPlan(SamplerConfig, reals, Zs, start)
+    with torch.no_grad():
+        torch.manual_seed(3)
+        images = None
+        for idx in range(len(Gs)):
+            images = planned_scale(SamplerConfig, plan, idx, Gs, Zs, noise_amps, images, start, 2)
+        torch.manual_seed(3)
+        sampled = sampler(2)
+    assert sampled.dtype == torch.float32
+    assert torch.equal(images, sampled)
+
+
+def keyed_samples(pyramid, plan, cache, first_sample):
+    reals, Gs, Zs, noise_amps = pyramid
+    start = torch.full(reals[0].shape, 0)
+    return stream_samples(KeyedConfig, reals, Gs, Zs, noise_amps, start, 4, 2, plan=plan, cache=cache,
+                          first_sample=first_sample)
+
+
+def test_interleaved_streams_sharing_a_plan_are_independent():
+    pyramid = trained_like_pyramid()
+    reals, Zs = pyramid[0], pyramid[2]
+    expected = {}
+    for first_sample in (0, 4):
+        plan = PyramidPlan(KeyedConfig, reals, Zs, torch.full(reals[0].shape, 0))
+        expected.update({start: images for start, _, images in keyed_samples(pyramid, plan, None, first_sample)})
+
+    plan, cache = PyramidPlan(KeyedConfig, reals, Zs, torch.full(reals[0].shape, 0)), PrefixCache()
+    a, b = keyed_samples(pyramid, plan, cache, 0), keyed_samples(pyramid, plan, cache, 4)
+    sampled = {}
+    for (start_a, _, images_a), (start_b, _, images_b) in zip(a, b):
+        sampled[start_a], sampled[start_b] = images_a, images_b
+    assert sampled.keys() == expected.keys()
+    for start in expected:
+        assert torch.equal(sampled[start], expected[start])
+
+
+def test_threads_sharing_a_plan_are_independent():
+    pyramid = trained_like_pyramid()
+    reals, Zs = pyramid[0], pyramid[2]
+    plan = PyramidPlan(KeyedConfig, reals, Zs, torch.full(reals[0].shape, 0))
+    expected = [images for _, _, images in keyed_samples(pyramid, plan, None, 0)]
+
+    results, errors = [], []
+
+    def run():
+        try:
+            for _ in range(5):
+                results.append([images for _, _, images in keyed_samples(pyramid, plan, None, 0)])
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors and len(results) == 15
+    for sampled in results:
+        assert all(torch.equal(images, target) for images, target in zip(sampled, expected))
@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from config import Config
+from model.generator import Generator
+from model.sampler import run_generator
+from utils.layers import weights_init
+
+
+class TileConfig(Config):
+    device = torch.device('cpu')
+
+
+@pytest.mark.parametrize('tile_size', [
+    16,         # divides the 64 rows, not the 75 columns
+    37,         # divides neither
+    64,         # one tile high, two tiles wide
+    3,          # smaller than the 2 * 5 pixel overlap of neighbouring input tiles
+])
+def test_tiled_generator_matches_whole_canvas(tile_size):
+    margin = int(((TileConfig.kernel_size - 1) * TileConfig.num_layers) / 2)
+    torch.manual_seed(0)
+    G = Generator(TileConfig)
+    G.apply(weights_init)
+    G.eval()
+    x = torch.randn(2, 3, 64 + 2 * margin, 75 + 2 * margin)
+    y = torch.rand(2, 3, 64 + 2 * margin, 75 + 2 * margin) * 2 - 1
+
+    # oneDNN picks conv kernels by input shape, which moves results by ~1e-7. The native kernels show that the
+    # tiles themselves are exact
+    with torch.no_grad(), torch.backends.mkldnn.flags(enabled=False):
+        expected = G(x, y)
+        TileConfig.infer_tile_size = tile_size
+        tiled = run_generator(TileConfig, G, x, y)
+    assert tiled.shape == expected.shape == (2, 3, 64, 75)
+    assert torch.equal(tiled, expected)
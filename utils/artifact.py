@@ -0,0 +1,139 @@
+import os
+import types
+
+import torch
+
+from model.generator import Generator
+from model.ACM_discriminator import ACMDiscriminator
+from utils.checkpoint import atomic_save
+
+ARTIFACT_VERSION = 1
+# Per-scale pickles written during training for resuming, model.pt replaces them once training is done
+LEGACY_FILES = {'Gs': 'Gs', 'Ds': 'Ds', 'Zs': 'Zs', 'reals': 'reals', 'noiseAmp': 'noise_amps'}
+# Config fields the per-scale networks are built from
+NETWORK_FIELDS = ('img_channel', 'kernel_size', 'num_layers', 'pad', 'num_heads', 'use_acm_oth')
+
+
+class LazyScales:
+    # List-like view over per-scale modules (or tensors) that are built from the artifact on first access. source names
+    # the artifact payload they come from, so a scale can be identified (e.g. for the prefix cache) without building it
+    def __init__(self, build, num_scales, source=None):
+        self.build = build
+        self.modules = [None] * num_scales
+        self.source = source
+
+    def __len__(self):
+        return len(self.modules)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if self.modules[idx] is None:
+            # Module init draws random weights, keep that from shifting the caller's sampling RNG
+            with torch.random.fork_rng(devices=[]):
+                self.modules[idx] = self.build(idx)
+        return self.modules[idx]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def materialized(self):
+        return [idx for idx, module in enumerate(self.modules) if module is not None]
+
+    def identity(self, idx):
+        return None if self.source is None else self.source + (idx % len(self),)
+
+
+def scale_config(config, meta, idx):
+    # Config view with the network width of scale idx, without touching the shared config
+    fields = {k: getattr(config, k) for k in dir(config) if not k.startswith('__')}
+    fields.update(meta['network'])
+    fields.update(meta['scales'][idx])
+    return types.SimpleNamespace(**fields)
+
+
+def save_artifact(path, Gs, Zs, reals, noise_amps, scale_nfcs, config, Ds=None, fp16=False):
+    # Single self-describing file: a flat name -> tensor dict plus metadata, loadable with torch.load(mmap=True)
+    def store(t):
+        t = t.detach().cpu()
+        return t.half() if fp16 and t.is_floating_point() else t.contiguous()
+
+    tensors = {}
+    for prefix, modules in (('G', Gs), ('D', Ds or [])):
+        for idx, module in enumerate(modules):
+            for name, value in module.state_dict().items():
+                tensors[f'{prefix}.{idx}.{name}'] = store(value)
+    for idx, (Z, real, noise_amp) in enumerate(zip(Zs, reals, noise_amps)):
+        tensors[f'Z.{idx}'] = store(Z)
+        tensors[f'real.{idx}'] = store(real)
+        tensors[f'noise_amp.{idx}'] = torch.tensor(float(noise_amp))
+
+    meta = {'version': ARTIFACT_VERSION, 'num_scales': len(Gs), 'has_ds': Ds is not None, 'fp16': fp16,
+            'network': {k: getattr(config, k) for k in NETWORK_FIELDS},
+            'scales': [{'nfc': nfc, 'min_nfc': min_nfc} for nfc, min_nfc in scale_nfcs]}
+    atomic_save({'meta': meta, 'tensors': tensors}, path)
+
+
+def finish_artifact(config, Gs, Zs, reals, noise_amps, scale_nfcs, Ds=None):
+    # Writes model.pt once for the finished pyramid and drops the per-scale pickles it replaces. Without pickles
+    # nothing was trained since the last model.pt
+    if not os.path.exists(f'{config.exp_dir}/Gs.pth'):
+        return
+    save_artifact(f'{config.exp_dir}/model.pt', Gs, Zs, reals, noise_amps, scale_nfcs, config, Ds=Ds, fp16=config.artifact_fp16)
+    for name in LEGACY_FILES:
+        if os.path.exists(f'{config.exp_dir}/{name}.pth'):
+            os.remove(f'{config.exp_dir}/{name}.pth')
+
+
+def load_artifact(path, config, load_ds=False):
+    # Tensors stay memory-mapped and every per-scale entry is moved to the device or built (discriminators only with
+    # load_ds) on first access
+    try:
+        artifact = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        artifact = torch.load(path, map_location='cpu')
+    meta, tensors = artifact['meta'], artifact['tensors']
+    if meta['version'] != ARTIFACT_VERSION:
+        raise Exception(f'Unsupported artifact version {meta["version"]}')
+
+    def tensor(name):
+        t = tensors[name]
+        return (t.float() if t.is_floating_point() else t).to(config.device)
+
+    def state_dict(prefix):
+        return {name[len(prefix):]: tensor(name) for name in tensors if name.startswith(prefix)}
+
+    def scales(build, kind):
+        # The file is only read through the mapping, so its path and stat name the payload of every scale
+        stat = os.stat(path)
+        source = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, kind, str(config.device), torch.float32)
+        return LazyScales(build, meta['num_scales'], source)
+
+    reals = scales(lambda idx: tensor(f'real.{idx}'), 'real')
+
+    def build_generator(idx):
+        G = Generator(scale_config(config, meta, idx)).to(config.device)
+        return freeze(G, state_dict(f'G.{idx}.'))
+
+    def build_discriminator(idx):
+        c = scale_config(config, meta, idx)
+        D = ACMDiscriminator(c, c.num_heads, reals[idx]).to(config.device)
+        return freeze(D, state_dict(f'D.{idx}.'))
+
+    return {
+        'Gs': scales(build_generator, 'G'),
+        'Ds': scales(build_discriminator, 'D') if load_ds and meta['has_ds'] else None,
+        'Zs': scales(lambda idx: tensor(f'Z.{idx}'), 'Z'),
+        'reals': reals,
+        'noise_amps': scales(lambda idx: tensor(f'noise_amp.{idx}'), 'noise_amp'),
+    }
+
+
+def freeze(module, state_dict):
+    module.load_state_dict(state_dict)
+    for p in module.parameters():
+        p.requires_grad_(False)
+    return module.eval()
@@ -0,0 +1,53 @@
+import functools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import matplotlib.pyplot as plt
+
+from utils.image import denormalize
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(name, device):
+    # [256, 3] RGB lookup table of a matplotlib colormap
+    lut = plt.get_cmap(name)(np.linspace(0, 1, 256))[:, :3]
+    return torch.tensor(lut, dtype=torch.float32, device=device)
+
+
+def composite_heatmaps(img, att_maps, alpha=0.4, cmap='viridis'):
+    # img: [B, C, H, W] in [-1, 1], att_maps: [B, num_heads, h, w] -> [B, num_heads, 3, H, W] in [0, 1].
+    # All heads are resized, colored and blended onto the image in one pass
+    att_maps = att_maps.detach().float()
+    img = denormalize(img.detach().float())
+    B, num_heads = att_maps.shape[:2]
+    H, W = img.shape[2:]
+
+    att_maps = F.interpolate(att_maps, size=(H, W), mode='bilinear', align_corners=False)
+
+    # Min-max normalize every head on its own
+    flat = att_maps.reshape(B, num_heads, -1)
+    low = flat.min(dim=2, keepdim=True)[0]
+    high = flat.max(dim=2, keepdim=True)[0]
+    flat = (flat - low) / (high - low).clamp_min(1e-12)
+
+    lut = colormap_lut(cmap, att_maps.device)
+    colors = lut[(flat * 255).round().long()]                              # [B, num_heads, H * W, 3]
+    colors = colors.permute(0, 1, 3, 2).reshape(B, num_heads, 3, H, W)
+    return (1 - alpha) * img.unsqueeze(1) + alpha * colors
+
+
+def heatmap_frames(composited):
+    # [B, num_heads, 3, H, W] in [0, 1] -> [B, num_heads, H, W, 3] uint8 on the CPU
+    frames = (composited.clamp(0, 1) * 255).round().to(torch.uint8)
+    return frames.permute(0, 1, 3, 4, 2).cpu().numpy()
+
+
+def heatmap_grid(frames, ncol=4):
+    # [num_heads, H, W, 3] uint8 -> one [rows * H, ncol * W, 3] image, heads in row-major order
+    num_heads, H, W, C = frames.shape
+    ncol = min(ncol, num_heads)
+    nrow = -(-num_heads // ncol)
+    padded = np.zeros((nrow * ncol, H, W, C), dtype=frames.dtype)
+    padded[:num_heads] = frames
+    return padded.reshape(nrow, ncol, H, W, C).transpose(0, 2, 1, 3, 4).reshape(nrow * H, ncol * W, C)
@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import uuid
+
+import torch
+import numpy as np
+
+from utils.image import RESIZE_VERSION
+
+# Config fields that change the content of creat_reals_pyramid output
+PYRAMID_KEY_FIELDS = ('scale_factor', 'min_size', 'max_size', 'start_scale', 'stop_scale', 'sr_factor')
+MANIFEST_NAME = 'manifest.json'
+# Renamed-away entries and abandoned temporary builds, both hidden and named after the first 16 key digits
+SCRATCH_DIR_RE = re.compile(r'^\.[0-9a-f]{16}-')
+SCRATCH_MAX_AGE = 60 * 60      # seconds, longer than any run keeps a replaced entry mapped
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pyramid_cache_key(config):
+    fields = {name: repr(getattr(config, name, None)) for name in PYRAMID_KEY_FIELDS}
+    fields['resize_version'] = repr(RESIZE_VERSION)     # Pyramids made by an older resize are not reused
+    image_hash = file_sha256(config.img_path)
+    key = hashlib.sha256(json.dumps({'image': image_hash, 'fields': fields}, sort_keys=True).encode()).hexdigest()
+    return key, image_hash, fields
+
+
+def remove_stale_entries(cache_dir, max_age=SCRATCH_MAX_AGE):
+    # Runs when the cache is opened. Entries that are still mapped or still being built are younger than max_age,
+    # anything that can't be removed now is left for the next run
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        try:
+            if SCRATCH_DIR_RE.match(name) and now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path)
+        except OSError:
+            pass
+
+
+def load_pyramid(cache_dir, key, device):
+    # Returns the cached levels as tensors backed by memory-mapped .npy files, or None if missing/invalid
+    pyramid_dir = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(pyramid_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['key'] != key:
+            return None
+
+        reals = []
+        for level in manifest['levels']:
+            level_path = os.path.join(pyramid_dir, level['file'])
+            if os.path.getsize(level_path) != level['file_size']:
+                return None
+            # Copy-on-write mapping: pages are only read when touched and the tensor stays writable
+            arr = np.load(level_path, mmap_mode='c')
+            if list(arr.shape) != level['shape'] or str(arr.dtype) != level['dtype']:
+                return None
+            reals.append(torch.from_numpy(arr).to(device))
+    except (OSError, ValueError, KeyError):
+        return None
+    return reals
+
+
+def save_pyramid(cache_dir, key, reals, image_hash, fields):
+    pyramid_dir = os.path.join(cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(pyramid_dir):
+        # An invalid entry. Other runs may still have its levels memory-mapped, so it is renamed out of the way
+        # instead of deleted
+        stale_dir = os.path.join(cache_dir, f'.{key[:16]}-stale-{uuid.uuid4().hex}')
+        try:
+            os.rename(pyramid_dir, stale_dir)
+            os.utime(stale_dir)     # remove_stale_entries() ages it from now
+        except OSError:
+            pass
+
+    # Build the entry in a temporary directory and rename it in place, so concurrent jobs never see half a pyramid
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{key[:16]}-', dir=cache_dir)
+    levels = []
+    for i, real in enumerate(reals):
+        file_name = f'level_{i}.npy'
+        arr = real.detach().cpu().numpy()
+        np.save(os.path.join(tmp_dir, file_name), arr)
+        levels.append({'file': file_name, 'shape': list(arr.shape), 'dtype': str(arr.dtype),
+                       'file_size': os.path.getsize(os.path.join(tmp_dir, file_name))})
+
+    manifest = {'key': key, 'image_sha256': image_hash, 'fields': fields, 'levels': levels}
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    try:
+        os.rename(tmp_dir, pyramid_dir)
+    except OSError:
+        # Another job stored the same pyramid first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
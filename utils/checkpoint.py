@@ -0,0 +1,77 @@
+import os
+import random
+
+import torch
+import numpy as np
+
+
+def atomic_save(obj, path):
+    # Write to a temporary file next to the target and rename it over, a killed job never leaves a torn file
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load(path, map_location=None):
+    # Checkpoints hold pickled modules and RNG states, not only tensors
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location=map_location)
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'random': random.getstate(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_path(config):
+    return f'{config.exp_dir}/checkpoint.pth'
+
+
+def remove_checkpoint(config):
+    # Nothing is left to resume once the last scale is done
+    if os.path.exists(checkpoint_path(config)):
+        os.remove(checkpoint_path(config))
+
+
+def load_checkpoint(config, scale):
+    # Mid-scale checkpoint of the given scale, None when there is nothing to resume
+    path = checkpoint_path(config)
+    if not config.resume or not os.path.exists(path):
+        return None
+    checkpoint = load(path, map_location=config.device)
+    if checkpoint['scale'] != scale:
+        return None
+    return checkpoint
+
+
+def load_finished_scales(config, names):
+    # Per-scale lists saved at the end of each finished scale, truncated to the scales present in all of them.
+    # A finished run only has model.pt left
+    paths = [f'{config.exp_dir}/{name}.pth' for name in names]
+    if not config.resume:
+        return None
+    if not all(os.path.exists(path) for path in paths):
+        if not os.path.exists(f'{config.exp_dir}/model.pt'):
+            return None
+        from utils.artifact import LEGACY_FILES, load_artifact
+        artifact = load_artifact(f'{config.exp_dir}/model.pt', config, load_ds='Ds' in names)
+        if 'Ds' in names and artifact['Ds'] is None:
+            # SinGAN_ACM always stores its discriminators, this model.pt was written by a plain SinGAN run
+            raise Exception(f'{config.exp_dir}/model.pt has no discriminators to resume SinGAN_ACM from, '
+                            'use another exp_dir or turn resume off')
+        return [list(artifact[LEGACY_FILES[name]]) for name in names]
+    lists = [load(path, map_location=config.device) for path in paths]
+    num_scales = min(len(l) for l in lists)
+    return [l[:num_scales] for l in lists]
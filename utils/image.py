@@ -1,12 +1,19 @@
 # This code was taken from: https://github.com/assafshocher/resizer by Assaf Shocher
+import threading
 from math import pi
+from collections import OrderedDict
 
 import torch
 import numpy as np
 from skimage import io
+from scipy import sparse
 from scipy.ndimage import filters, measurements, interpolation
 
 
+# Bump when the resize output changes, it is part of the pyramid cache key
+RESIZE_VERSION = 2
+
+
 def normalize(x):
     # [0, 1] -> [-1, 1]
     normalized = (x - 0.5) * 2
@@ -70,10 +77,9 @@ def read_img(config):
 
 
 def resize_img(img, scale, config):
-    img = torch2uint8(img)
-    img = imresize_in(img, scale_factor=scale)
-    img = np2torch(img, config)
-    return img
+    # Resize on the tensor's own device/dtype, no uint8 round trip through numpy
+    img = imresize_torch(img, scale_factor=scale)
+    return img.clamp(-1, 1)
 
 
 def imresize_in(im, scale_factor=None, output_shape=None, kernel=None, antialiasing=True, kernel_shift_flag=False):
@@ -84,16 +90,6 @@ def imresize_in(im, scale_factor=None, output_shape=None, kernel=None, antialias
     if type(kernel) == np.ndarray and scale_factor[0] <= 1:
         return numeric_kernel(im, kernel, scale_factor, output_shape, kernel_shift_flag)
 
-    # Choose interpolation method, each method has the matching kernel size
-    method, kernel_width = {
-        "cubic": (cubic, 4.0),
-        "lanczos2": (lanczos2, 4.0),
-        "lanczos3": (lanczos3, 6.0),
-        "box": (box, 1.0),
-        "linear": (linear, 2.0),
-        None: (cubic, 4.0)  # set default interpolation method as cubic
-    }.get(kernel)
-
     # Antialiasing is only used when downscaling
     antialiasing *= (scale_factor[0] < 1)
 
@@ -107,17 +103,139 @@ def imresize_in(im, scale_factor=None, output_shape=None, kernel=None, antialias
         if scale_factor[dim] == 1.0:
             continue
 
-        # for each coordinate (along 1 dim), calculate which coordinates in the input image affect its result and the
-        # weights that multiply the values there to get its result.
-        weights, field_of_view = contributions(im.shape[dim], output_shape[dim], scale_factor[dim],
-                                               method, kernel_width, antialiasing)
+        # for each coordinate (along 1 dim), the (cached) sparse operator holds which coordinates in the input image
+        # affect its result and the weights that multiply the values there to get its result.
+        operator = resize_operator(im.shape[dim], output_shape[dim], scale_factor[dim], kernel, antialiasing)
 
-        # Use the affecting position values and the set of weights to calculate the result of resizing along this 1 dim
-        out_im = resize_along_dim(out_im, dim, weights, field_of_view)
+        # Resizing along this 1 dim is a single sparse matmul
+        out_im = apply_resize_operator(out_im, dim, operator)
 
     return out_im
 
 
+def imresize_torch(x, scale_factor=None, output_shape=None, kernel=None, antialiasing=True):
+    # Same resampling as imresize_in, but applied on a [B, C, H, W] tensor without leaving its device and dtype.
+    # Integer input (e.g. the zero start image) is resized in the default float dtype
+    if not x.is_floating_point():
+        x = x.to(torch.get_default_dtype())
+    scale_factor, output_shape = fix_scale_and_size(x.shape[2:], output_shape, scale_factor)
+
+    # Antialiasing is only used when downscaling
+    antialiasing *= (scale_factor[0] < 1)
+
+    out = x
+    for dim in np.argsort(np.array(scale_factor)).tolist():
+        if scale_factor[dim] == 1.0:
+            continue
+        weights, field_of_view = resize_operator_torch(x.shape[dim + 2], output_shape[dim], scale_factor[dim], kernel,
+                                                       antialiasing, x.device, x.dtype)
+        out = resize_along_dim_torch(out, dim + 2, weights, field_of_view)
+
+    return out
+
+
+class ResizeOperatorCache:
+    # Bounded LRU of per-axis resampling operators. The pyramid only ever resizes between a handful of
+    # (in_length, out_length, scale, kernel) combinations, so rebuilding contributions() every call is wasted work.
+    def __init__(self, max_entries=128, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Resizes also run from background threads (prior prefetcher)
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = build()
+        size = operator_nbytes(value)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.nbytes += size
+            # Evict least recently used operators, but always keep the one just built
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'nbytes': self.nbytes,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+
+resize_operators = ResizeOperatorCache()
+
+
+def operator_nbytes(value):
+    if sparse.issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return sum(t.element_size() * t.nelement() for t in value)
+
+
+def resize_weights(in_length, out_length, scale, kernel, antialiasing):
+    # contributions() squeezes its outputs, this keeps the [out_length, kernel_size] layout
+    method, kernel_width = interpolation_method(kernel)
+    weights, field_of_view = contributions(in_length, out_length, scale, method, kernel_width, antialiasing)
+    weights = np.reshape(weights, (out_length, -1))
+    field_of_view = np.reshape(field_of_view, (out_length, -1)).astype(np.int64)
+    return weights, field_of_view
+
+
+def resize_operator(in_length, out_length, scale, kernel=None, antialiasing=True):
+    # [out_length, in_length] sparse matrix, one row of kernel weights per output pixel
+    in_length, out_length, scale, antialiasing = int(in_length), int(out_length), float(scale), bool(antialiasing)
+
+    def build():
+        weights, field_of_view = resize_weights(in_length, out_length, scale, kernel, antialiasing)
+        rows = np.repeat(np.arange(out_length), weights.shape[1])
+        # Duplicated columns (reflection at the borders) are summed up by the csr constructor
+        operator = sparse.csr_matrix((weights.ravel(), (rows, field_of_view.ravel())), shape=(out_length, in_length))
+        operator.eliminate_zeros()
+        return operator
+
+    return resize_operators.get(('sparse', in_length, out_length, scale, kernel, antialiasing), build)
+
+
+def resize_operator_torch(in_length, out_length, scale, kernel, antialiasing, device, dtype):
+    # Banded form of resize_operator for tensors: [out_length, kernel_size] weights and input indices
+    in_length, out_length, scale, antialiasing = int(in_length), int(out_length), float(scale), bool(antialiasing)
+
+    def build():
+        weights, field_of_view = resize_weights(in_length, out_length, scale, kernel, antialiasing)
+        return (torch.from_numpy(weights).to(device=device, dtype=dtype),
+                torch.from_numpy(field_of_view).to(device=device))
+
+    key = ('torch', in_length, out_length, scale, kernel, antialiasing, str(device), dtype)
+    return resize_operators.get(key, build)
+
+
+def interpolation_method(kernel):
+    return {
+        "cubic": (cubic, 4.0),
+        "lanczos2": (lanczos2, 4.0),
+        "lanczos3": (lanczos3, 6.0),
+        "box": (box, 1.0),
+        "linear": (linear, 2.0),
+        None: (cubic, 4.0)  # set default interpolation method as cubic
+    }.get(kernel)
+
+
 def fix_scale_and_size(input_shape, output_shape, scale_factor):
     # First fixing the scale-factor (if given) to be standardized the function expects (a list of scale factors in the
     # same size as the number of input dimensions)
@@ -207,24 +325,23 @@ def contributions(in_length, out_length, scale, kernel, kernel_width, antialiasi
     return weights, field_of_view
 
 
-def resize_along_dim(im, dim, weights, field_of_view):
-    # To be able to act on each dim, we swap so that dim 0 is the wanted dim to resize
-    tmp_im = np.swapaxes(im, dim, 0)
-
-    # We add singleton dimensions to the weight matrix so we can multiply it with the big tensor we get for
-    # tmp_im[field_of_view.T], (bsxfun style)
-    weights = np.reshape(weights.T, list(weights.T.shape) + (np.ndim(im) - 1) * [1])
+def apply_resize_operator(im, dim, operator):
+    # Move the wanted dim first and flatten the rest so the whole resize along it is one (sparse x dense) matmul
+    tmp_im = np.moveaxis(im, dim, 0)
+    out_shape = (operator.shape[0],) + tmp_im.shape[1:]
+    tmp_out_im = operator @ tmp_im.reshape(tmp_im.shape[0], -1)
+    return np.moveaxis(np.asarray(tmp_out_im).reshape(out_shape), 0, dim)
 
-    # This is a bit of a complicated multiplication: tmp_im[field_of_view.T] is a tensor of order image_dims+1.
-    # for each pixel in the output-image it matches the positions the influence it from the input image (along 1 dim
-    # only, this is why it only adds 1 dim to the shape). We then multiply, for each pixel, its set of positions with
-    # the matching set of weights. we do this by this big tensor element-wise multiplication (MATLAB bsxfun style:
-    # matching dims are multiplied element-wise while singletons mean that the matching dim is all multiplied by the
-    # same number
-    tmp_out_im = np.sum(tmp_im[field_of_view.T] * weights, axis=0)
 
-    # Finally we swap back the axes to the original order
-    return np.swapaxes(tmp_out_im, dim, 0)
+def resize_along_dim_torch(x, dim: int, weights, field_of_view):
+    # Resize along one dim with a banded operator. Instead of materializing x[field_of_view] (kernel_size times the
+    # image), accumulate one weighted tap of the kernel at a time. Scriptable, the compiled pyramid sampler uses it too
+    shape = [1] * x.dim()
+    shape[dim] = -1
+    out = x.index_select(dim, field_of_view[:, 0]) * weights[:, 0].view(shape)
+    for tap in range(1, field_of_view.shape[1]):
+        out = out + x.index_select(dim, field_of_view[:, tap]) * weights[:, tap].view(shape)
+    return out
 
 
 def numeric_kernel(im, kernel, scale_factor, output_shape, kernel_shift_flag):
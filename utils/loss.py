@@ -2,8 +2,9 @@ import torch
 
 
 def calcul_gp(discriminator, real, fake, device, use_acm=True):
-    alpha = torch.rand(1, 1)
-    alpha = alpha.expand(real.size())
+    # One interpolation factor per sample of the (mini)batch of fakes, the real image broadcasts against it
+    alpha = torch.rand(fake.size(0), 1, 1, 1)
+    alpha = alpha.expand(fake.size())
     alpha = alpha.to(device)
 
     interpolated = alpha * real + ((1 - alpha) * fake)
@@ -20,3 +21,28 @@ def calcul_gp(discriminator, real, fake, device, use_acm=True):
                                     create_graph=True, retain_graph=True, only_inputs=True)[0]
     gp = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
     return gp
+
+
+def calcul_r1(discriminator, real, device, use_acm=True):
+    # R1 penalty: squared gradient norm of D on the real image
+    real = real.detach().to(device).requires_grad_(True)
+    if use_acm:
+        real_prob_out, _, _, _ = discriminator(real)
+    else:
+        real_prob_out = discriminator(real)
+
+    gradients = torch.autograd.grad(outputs=real_prob_out.sum(), inputs=real, create_graph=True, retain_graph=True)[0]
+    r1 = gradients.pow(2).sum(dim=[1, 2, 3]).mean()
+    return r1
+
+
+def lazy_penalty(discriminator, real, fake, device, step, config, use_acm=True):
+    # Lazy regularization: the (double backward) penalty is only applied every gp_interval critic steps, with its
+    # weight scaled by gp_interval to keep the same strength on average. Returns None on skipped steps
+    if step % config.gp_interval != 0:
+        return None
+    if config.gp_type == 'r1':
+        penalty = calcul_r1(discriminator, real, device, use_acm)
+    else:
+        penalty = calcul_gp(discriminator, real, fake, device, use_acm)
+    return penalty * config.gp_interval
@@ -0,0 +1,65 @@
+import queue
+import threading
+
+import torch
+
+
+class MetricsBuffer:
+    # Keeps per-epoch losses as detached device tensors and only syncs every flush_iter epochs, with one stacked
+    # copy to the host. The SummaryWriter calls run on a background thread, tags and steps are unchanged.
+    def __init__(self, writer, flush_iter=50):
+        self.writer = writer
+        self.flush_iter = max(1, flush_iter)
+        self.pending = []                       # (step, {tag: detached tensor or float})
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.write, name='metrics-writer', daemon=True)
+        self.thread.start()
+
+    def log(self, values, step):
+        # values: {tag: tensor or number} for one step, tensors must not need a graph anymore
+        if values:
+            self.pending.append((step, {tag: value.detach() if torch.is_tensor(value) else value for tag, value in values.items()}))
+        if len(self.pending) >= self.flush_iter:
+            self.flush()
+
+    def scalar(self, tag, value, step):
+        # Host-side values that are written right away, in order with the buffered ones
+        self.flush()
+        self.queue.put([(tag, value, step)])
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if not self.pending:
+            return
+
+        # A single device -> host copy for every buffered tensor
+        tensors = [value for _, values in self.pending for value in values.values() if torch.is_tensor(value)]
+        if tensors:
+            host = iter(torch.stack([t.float().mean() for t in tensors]).cpu().tolist())
+        items = []
+        for step, values in self.pending:
+            for tag, value in values.items():
+                items.append((tag, next(host) if torch.is_tensor(value) else value, step))
+        self.pending = []
+        self.queue.put(items)
+
+    def write(self):
+        while True:
+            items = self.queue.get()
+            if items is None:
+                return
+            try:
+                for tag, value, step in items:
+                    self.writer.add_scalar(tag, value, step)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.flush()
+        if self.error is not None:
+            raise self.error
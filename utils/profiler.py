@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import resource
+import contextlib
+
+import torch
+
+
+class PhaseProfiler:
+    # Opt-in wall-clock timer for the training phases of every scale, with peak memory per scale. Exports a
+    # summary table and a Chrome / Perfetto trace (chrome://tracing, ui.perfetto.dev), one track per scale.
+    def __init__(self, enabled=False, sync=True, device=None):
+        self.enabled = enabled
+        self.sync = sync and device is not None and device.type == 'cuda' and torch.cuda.is_available()
+        self.device = device
+        self.origin = time.perf_counter()
+        self.scale = -1                         # -1: work outside of a scale, e.g. the pyramid build
+        self.events = []                        # (name, scale, start sec, duration sec)
+        self.peak_memory = {}                   # scale -> {'cpu_mb': .., 'cuda_mb': ..}
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.events.append((name, self.scale, start - self.origin, self.now() - start))
+
+    def phase(self, name):
+        return self.timed(name) if self.enabled else contextlib.nullcontext()
+
+    def start_scale(self, scale):
+        if not self.enabled:
+            return
+        self.scale = scale
+        if self.sync:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def end_scale(self):
+        if not self.enabled:
+            return
+        # ru_maxrss is in KB on Linux and never goes down, so it is the process peak up to this scale
+        memory = {'cpu_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if self.sync:
+            memory['cuda_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        self.peak_memory[self.scale] = memory
+        self.scale = -1
+
+    def totals(self):
+        # {scale: {phase: [total sec, count]}}
+        totals = {}
+        for name, scale, _, duration in self.events:
+            phase = totals.setdefault(scale, {}).setdefault(name, [0, 0])
+            phase[0] += duration
+            phase[1] += 1
+        return totals
+
+    def summary(self):
+        lines = [f'{"scale":>5} {"phase":<20} {"total_sec":>10} {"count":>7} {"ms/call":>9} {"share":>7}']
+        for scale, phases in sorted(self.totals().items()):
+            scale_total = sum(total for total, _ in phases.values())
+            for name, (total, count) in sorted(phases.items(), key=lambda item: -item[1][0]):
+                lines.append(f'{scale:>5} {name:<20} {total:>10.3f} {count:>7} {1000 * total / count:>9.3f} '
+                             f'{100 * total / max(scale_total, 1e-12):>6.1f}%')
+            memory = ', '.join(f'{k}={v:.1f}' for k, v in self.peak_memory.get(scale, {}).items())
+            if memory:
+                lines.append(f'{scale:>5} {"peak memory":<20} {memory}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        events = []
+        for name, scale, start, duration in self.events:
+            events.append({'name': name, 'cat': 'train', 'ph': 'X', 'pid': 0, 'tid': scale,
+                           'ts': start * 1e6, 'dur': duration * 1e6})
+        for scale in sorted({scale for _, scale, _, _ in self.events}):
+            label = 'setup' if scale < 0 else f'{scale}th GAN'
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': scale, 'args': {'name': label}})
+        for scale, memory in self.peak_memory.items():
+            ends = [start + duration for _, s, start, duration in self.events if s == scale]
+            events.append({'name': 'peak memory (MB)', 'ph': 'C', 'pid': 0,
+                           'ts': max(ends, default=0) * 1e6, 'args': memory})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, out_dir):
+        if not self.enabled:
+            return
+        os.makedirs(out_dir, exist_ok=True)
+        summary = self.summary()
+        with open(f'{out_dir}/profile_summary.txt', 'w') as f:
+            f.write(summary + '\n')
+        with open(f'{out_dir}/profile_trace.json', 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        print(summary)
@@ -2,9 +2,11 @@ import math
 import random
 import multiprocessing
 
+import numpy as np
 import torch
 import torch.nn as nn
-from utils.image import resize_img
+from utils.image import read_img, resize_img
+from utils.cache import pyramid_cache_key, load_pyramid, save_pyramid, remove_stale_entries
 
 
 def process_config(config):
@@ -30,6 +32,13 @@ def process_config(config):
         config.alpha = 100
 
 
+def scale_nfc(config, scale_iter):
+    # Become larger as scale_iter increase (maximum=128)
+    nfc = min(config.nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
+    min_nfc = min(config.min_nfc_init * pow(2, math.floor(scale_iter / 4)), 128)
+    return nfc, min_nfc
+
+
 def adjust_scales(real, config):
     minwh = min(real.shape[2], real.shape[3])
     maxwh = max(real.shape[2], real.shape[3])
@@ -63,21 +72,47 @@ def creat_reals_pyramid(real, reals, config):
     return reals
 
 
+def load_reals_pyramid(config):
+    # Pyramid of the training image, served from config.pyramid_cache_dir when the same image/config was seen before
+    if config.pyramid_cache_dir is not None:
+        remove_stale_entries(config.pyramid_cache_dir)
+        key, image_hash, fields = pyramid_cache_key(config)
+        reals = load_pyramid(config.pyramid_cache_dir, key, config.device)
+        if reals is not None:
+            return reals
+
+    train_img = read_img(config)
+    real = resize_img(train_img, config.start_scale, config)
+    reals = creat_reals_pyramid(real, [], config)
+
+    if config.pyramid_cache_dir is not None:
+        save_pyramid(config.pyramid_cache_dir, key, reals, image_hash, fields)
+    return reals
+
+
 def upsampling(img, sx, sy):
     m = nn.Upsample(size=[round(sx), round(sy)], mode='bilinear', align_corners=True)
     return m(img)
 
 
-def generate_noise(size, num_noise=1, device='cuda', type='gaussian', scale=1):
+def generate_noise(size, num_noise=1, device='cuda', type='gaussian', scale=1, generator=None):
     if type == 'gaussian':
-        noise = torch.randn(num_noise, size[0], round(size[1]/scale), round(size[2]/scale), device=device)
+        noise = torch.randn(num_noise, size[0], round(size[1]/scale), round(size[2]/scale), device=device, generator=generator)
         noise = upsampling(noise, size[1], size[2])
     elif type =='gaussian_mixture':
-        noise1 = torch.randn(num_noise, size[0], size[1], size[2], device=device) + 5
-        noise2 = torch.randn(num_noise, size[0], size[1], size[2], device=device)
+        noise1 = torch.randn(num_noise, size[0], size[1], size[2], device=device, generator=generator) + 5
+        noise2 = torch.randn(num_noise, size[0], size[1], size[2], device=device, generator=generator)
         noise = noise1 + noise2
     elif type == 'uniform':
-        noise = torch.randn(num_noise, size[0], size[1], size[2], device=device)
+        noise = torch.randn(num_noise, size[0], size[1], size[2], device=device, generator=generator)
     else:
         raise Exception('Unimplemented noise type')
     return noise
+
+
+def generate_keyed_noise(size, seed, sample_ids, scale, device='cuda'):
+    # Counter-based gaussian noise (Philox): the map of every sample only depends on (seed, sample id, scale), not on
+    # anything drawn before it, so one sample can be regenerated alone and a job can be split across processes
+    noise = [np.random.Generator(np.random.Philox(np.random.SeedSequence([seed, sample_id, scale])))
+             .standard_normal([size[0], round(size[1]), round(size[2])], dtype=np.float32) for sample_id in sample_ids]
+    return torch.from_numpy(np.stack(noise)).to(device)
@@ -0,0 +1,227 @@
+import zlib
+import time
+import queue
+import struct
+import atexit
+import threading
+import multiprocessing
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from utils.image import torch2np
+
+POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+
+def to_uint8(x):
+    # [B, C, H, W] tensor in [-1, 1] (last sample) or [H, W, C] float array in [0, 1] -> [H, W, C] uint8
+    if not isinstance(x, np.ndarray):
+        x = torch2np(x)
+    if x.dtype != np.uint8:
+        x = (np.clip(x, 0, 1) * 255).astype(np.uint8)     # Same truncation as plt.imsave on float RGB
+    return x
+
+
+def write_png(path, image):
+    plt.imsave(path, image)
+
+
+class PNGStripWriter:
+    # Writes an 8-bit RGB PNG from top to bottom in strips of rows, so the full image never has to be in memory
+    def __init__(self, path, height, width):
+        self.file = open(path, 'wb')
+        self.height, self.width = height, width
+        self.rows = 0
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, rows):
+        # rows: [h, width, 3] uint8, each scanline goes out with filter type 0
+        assert rows.shape[1:] == (self.width, 3) and self.rows + rows.shape[0] <= self.height
+        scanlines = np.concatenate([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows.reshape(rows.shape[0], -1)], axis=1)
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self.chunk(b'IDAT', data)
+        self.rows += rows.shape[0]
+
+    def close(self):
+        assert self.rows == self.height, f'PNG has {self.rows} of {self.height} rows'
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.file.close()
+
+
+class ImageWriter:
+    # Bounded queue drained by background threads that encode and write the images, so PNG encoding and disk I/O
+    # stay off the training and inference loops. With num_workers=0 every job runs inline on the caller.
+    def __init__(self, num_workers=2, queue_size=32, policy='block'):
+        if policy not in POLICIES:
+            raise Exception(f'Unknown image writer policy {policy}, expected one of {POLICIES}')
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.lock = threading.Lock()
+        self.error = None
+        self.closed = False
+
+        # Bookkeeping for the backpressure the loops saw
+        self.num_written = 0
+        self.num_dropped = 0
+        self.wait_time = 0
+
+        self.threads = [threading.Thread(target=self.work, name=f'image-writer-{i}', daemon=True) for i in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.run(job)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job):
+        fn, args = job
+        try:
+            fn(*args)
+            with self.lock:
+                self.num_written += 1
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+
+    def save(self, path, image):
+        # The uint8 conversion is cheap and releases the caller's tensor right away
+        self.submit(write_png, path, to_uint8(image))
+
+    def submit(self, fn, *args):
+        self.check()
+        if self.closed:
+            raise RuntimeError('Image writer is closed')
+        job = (fn, args)
+        if not self.threads:
+            self.run(job)
+            return
+
+        start = time.perf_counter()
+        if self.policy == 'block':
+            self.queue.put(job)
+        elif self.policy == 'drop_new':
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self.drop()
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(job)
+                    break
+                except queue.Full:
+                    # Evict the oldest pending job to make room
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.drop()
+                    except queue.Empty:
+                        pass
+        self.wait_time += time.perf_counter() - start
+
+    def drop(self):
+        with self.lock:
+            self.num_dropped += 1
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        # Wait until every queued image is on disk
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        atexit.unregister(self.close)
+        self.check()
+
+    def stats(self):
+        return {'written': self.num_written, 'dropped': self.num_dropped, 'wait_sec': self.wait_time}
+
+
+def render_heatmaps(img, att_maps, paths):
+    # One task renders every head of a map. Only the ACM model needs the heatmap package
+    import heatmap
+    for att, path in zip(att_maps, paths):
+        heatmap.add(img, att, alpha=0.4, save=path, axis='off')
+
+
+class HeatmapPool:
+    # Long-lived process pool for the matplotlib attention heatmaps, created once per run instead of a fresh
+    # parmap pool per save. Jobs carry their output paths, nothing goes through module state.
+    def __init__(self, num_processes=4, max_pending=16):
+        self.num_processes = num_processes
+        self.max_pending = max_pending
+        self.pool = None
+        self.pending = []
+        self.num_rendered = 0
+
+    def submit(self, img, att_maps, save_prefix):
+        # img: [H, W, C] in [0, 1], att_maps: [num_heads, H, W, 1], heads are saved as {save_prefix}_{head}.png
+        paths = [f'{save_prefix}_{head}.png' for head in range(len(att_maps))]
+        if not self.num_processes:
+            render_heatmaps(img, att_maps, paths)
+            self.num_rendered += 1
+            return
+        if self.pool is None:
+            # Spawn, not fork: the image writer threads are already running and a forked child inherits their locks
+            self.pool = multiprocessing.get_context('spawn').Pool(self.num_processes)
+        self.pending.append(self.pool.apply_async(render_heatmaps, (img, att_maps, paths)))
+
+        # Backpressure: never keep more than max_pending maps in flight
+        while len(self.pending) > self.max_pending:
+            self.wait(self.pending.pop(0))
+
+    def wait(self, result):
+        result.get()
+        self.num_rendered += 1
+
+    def flush(self):
+        while self.pending:
+            self.wait(self.pending.pop(0))
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def stats(self):
+        return {'rendered': self.num_rendered, 'pending': len(self.pending)}
+
+
+def image_writer(config):
+    return ImageWriter(config.image_writer_workers, config.image_writer_queue, config.image_writer_policy)
+
+
+def heatmap_pool(config):
+    return HeatmapPool(config.heatmap_processes)